@@ -0,0 +1,40 @@
+import argparse
+import sys
+
+from benchmarks import suite
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m benchmarks', description='Run or compare benchmarks')
+    commands = parser.add_subparsers(dest='command', required=True)
+    run = commands.add_parser('run', help='run benchmarks and write the results as JSON')
+    run.add_argument('names', nargs='*', help='benchmarks to run (all by default): '
+                     + ', '.join(list(suite.SCENES) + list(suite.MICRO)))
+    run.add_argument('-o', '--output', default='benchmarks.json', help='file to write the results to')
+    run.add_argument('-f', '--frames', type=int, default=suite.FRAMES, help='frames rendered for each scene')
+    compare = commands.add_parser('compare', help='flag regressions of results against a baseline')
+    compare.add_argument('baseline', help='JSON file of baseline results')
+    compare.add_argument('results', help='JSON file of new results')
+    compare.add_argument('-t', '--threshold', type=float, default=suite.THRESHOLD,
+                         help='relative slowdown flagged as a regression')
+    args = parser.parse_args()
+
+    if args.command == 'run':
+        results = suite.run(args.names or None, args.frames)
+        for name, result in results['results'].items():
+            line = f'{name:<16}{1000*result["time"]:10.2f} ms'
+            if 'fps' in result:
+                line += f'{result["fps"]:10.1f} fps{result["faces_per_sec"]:14.0f} faces/s'
+            print(line)
+        suite.save(results, args.output)
+    else:
+        rows = suite.compare(suite.load(args.baseline), suite.load(args.results), args.threshold)
+        for name, metric, old, new, change, regressed in rows:
+            flag = '  REGRESSION' if regressed else ''
+            print(f'{name:<16}{metric:<10}{1000*old:10.2f} ms{1000*new:10.2f} ms{100*change:+8.1f}%{flag}')
+        if any(row[-1] for row in rows):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
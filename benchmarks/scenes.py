@@ -0,0 +1,73 @@
+import numpy as np
+
+from scene import Scene
+from manager import ModelManager
+
+SPACING = 4  # distance between neighbouring models
+DEPTH = 10  # distance of the nearest models from the camera
+
+
+def torus(n_faces, major_radius=1, minor_radius=0.4):
+    '''
+    Vertices and quadrilateral faces of a torus with about n_faces faces
+    '''
+    n_major = max(int(np.sqrt(2*n_faces)), 3)
+    n_minor = max(n_faces//n_major, 3)
+    u, v = np.meshgrid(np.arange(n_major)*2*np.pi/n_major, np.arange(n_minor)*2*np.pi/n_minor, indexing='ij')
+    radius = major_radius + minor_radius*np.cos(v)
+    vertices = np.stack((radius*np.cos(u), minor_radius*np.sin(v), radius*np.sin(u)), axis=-1).reshape((-1, 3))
+    i, j = np.meshgrid(np.arange(n_major), np.arange(n_minor), indexing='ij')
+    i1, j1 = (i + 1) % n_major, (j + 1) % n_minor
+    faces = np.stack((i*n_minor + j, i1*n_minor + j, i1*n_minor + j1, i*n_minor + j1), axis=-1).reshape((-1, 4))
+    return vertices, faces
+
+
+def build_scene(n_models=10, n_faces=200, behind=0., animated=False, rasterizer='painter', size=(400, 400)):
+    '''
+    Build a synthetic Scene of n_models models sharing a torus mesh of about n_faces faces, laid out
+    on a grid in front of the camera. A fraction of the models (behind) is placed behind the camera,
+    where they are culled. Animated models spin and bob up and down.
+    '''
+    manager = ModelManager()
+    vertices, faces = torus(n_faces)
+    manager.add_mesh('torus', vertices=vertices, faces=faces)
+
+    n_behind = int(round(behind*n_models))
+    columns = int(np.ceil(np.sqrt(n_models)))
+    rng = np.random.default_rng(0)
+    for i in range(n_models):
+        key = f'model{i}'
+        manager.add_model(key, mesh='torus')
+        manager.set_colour(key, tuple(int(c) for c in rng.integers(0, 256, 3)))
+        row, column = divmod(i, columns)
+        x, y = (column - (columns - 1)/2)*SPACING, (row - (columns - 1)/2)*SPACING
+        z = -DEPTH if i < n_behind else DEPTH + (i % 3)*SPACING
+        manager.set_position(key, (x, y, z))
+        if animated:
+            phase = rng.uniform(0, 2*np.pi)
+            manager.add_motion(key, positions=_bob(x, y, z, phase), orientations=_spin(phase))
+
+    scene = Scene()
+    scene.set_screen_size(*size)
+    scene.set_viewpoint((0, 0, 0))
+    scene.set_rasterizer(rasterizer)
+    scene.add_manager(manager)
+    return scene
+
+
+def _bob(x, y, z, phase):
+    '''
+    Motion moving a model up and down about a point
+    '''
+    def position(time):
+        return x, y + np.sin(2*time + phase), z
+    return position
+
+
+def _spin(phase):
+    '''
+    Motion spinning a model about its axes
+    '''
+    def orientation(time):
+        return time + phase, 0.5*time, 0.25*time
+    return orientation
@@ -0,0 +1,176 @@
+import atexit
+import json
+import os
+import platform
+import tempfile
+from time import perf_counter
+
+import numpy as np
+
+from models import Mesh, STL_HEADER_SIZE, STL_RECORD
+from profiler import STAGES, COUNTERS
+from benchmarks.scenes import build_scene, torus
+
+FRAMES = 30  # number of frames rendered for each scene benchmark
+REPEATS = 5  # number of repeats of each micro benchmark, of which the fastest is reported
+THRESHOLD = 0.15  # relative slowdown flagged as a regression
+MIN_TIME = 5e-4  # times (in seconds) below which stages are too noisy to compare
+
+# Synthetic scenes: number of models, faces per model, fraction of models behind the camera,
+# whether the models move, and the rasterizer
+SCENES = {
+    'static': dict(n_models=20, n_faces=200),
+    'animated': dict(n_models=20, n_faces=200, animated=True),
+    'many_models': dict(n_models=400, n_faces=24, animated=True),
+    'dense_mesh': dict(n_models=2, n_faces=20000),
+    'half_behind': dict(n_models=100, n_faces=200, behind=0.5),
+    'zbuffer': dict(n_models=20, n_faces=2000, rasterizer='zbuffer'),
+}
+
+
+def run_scene(params, frames=FRAMES):
+    '''
+    Render a synthetic scene headless for a number of frames. Returns the frame rate, the number
+    of faces processed per second and the mean time of each stage and counters per frame.
+    '''
+    scene = build_scene(**params)
+    scene.set_profiling(True, history=frames)
+    scene.render_frame(0)  # warm up caches (e.g. the projection and coherent sort state)
+    scene.get_profiler().clear()
+
+    times = np.arange(1, frames + 1)/30
+    start = perf_counter()
+    for _ in scene.render_frames(times):
+        pass
+    elapsed = perf_counter() - start
+    summary = scene.get_profiler().summary()
+    return {
+        'params': params,
+        'frames': frames,
+        'time': elapsed/frames,
+        'fps': frames/elapsed,
+        'faces_per_sec': summary['faces']*frames/elapsed,
+        'stages': {stage: summary[stage] for stage in STAGES},
+        'counters': {counter: summary[counter] for counter in COUNTERS},
+    }
+
+
+def bench_world_vertices():
+    '''
+    World-space vertices of many models sharing a mesh (ModelManager.get_vertex_array), after
+    the models have moved
+    '''
+    manager = build_scene(n_models=200, n_faces=2000).get_manager()
+    keys = manager.models
+    steps = iter(range(10**6))
+
+    def operation():
+        step = next(steps)
+        for key in keys:
+            manager.set_position(key, (step, 0, 0))
+        return [manager.get_vertex_array(key, world=True) for key in keys]
+    return operation
+
+
+def bench_motion():
+    '''
+    Evaluation of the motions of many animated models (ModelManager.update_models)
+    '''
+    manager = build_scene(n_models=1000, n_faces=24, animated=True).get_manager()
+    times = iter(np.arange(10**6)/30)
+    return lambda: manager.update_models(next(times))
+
+
+def bench_stl():
+    '''
+    Reading and welding the triangles of a binary STL file (Mesh._convert_stl)
+    '''
+    vertices, faces = torus(50000)
+    triangles = np.concatenate((faces[:, :3], faces[:, [0, 2, 3]]))
+    records = np.zeros(len(triangles), dtype=STL_RECORD)
+    records['vectors'] = vertices[triangles]
+    file = tempfile.NamedTemporaryFile(suffix='.stl', delete=False)
+    with file:
+        file.write(bytes(STL_HEADER_SIZE - 4) + np.uint32(len(records)).tobytes() + records.tobytes())
+    atexit.register(os.remove, file.name)
+    return lambda: Mesh._convert_stl(file.name)
+
+
+# Micro benchmarks of individual operations, as functions returning the operation to time
+MICRO = {
+    'world_vertices': bench_world_vertices,
+    'motion': bench_motion,
+    'stl': bench_stl,
+}
+
+
+def run_micro(setup, repeats=REPEATS):
+    '''
+    Time an operation, returning the fastest of several runs
+    '''
+    operation = setup()
+    operation()
+    timings = []
+    for _ in range(repeats):
+        start = perf_counter()
+        operation()
+        timings.append(perf_counter() - start)
+    return {'time': min(timings), 'repeats': repeats}
+
+
+def run(names=None, frames=FRAMES):
+    '''
+    Run the benchmarks with the given names (or all of them), returning a dictionary of results
+    '''
+    names = list(SCENES) + list(MICRO) if names is None else names
+    results = {}
+    for name in names:
+        if name in SCENES:
+            results[name] = run_scene(SCENES[name], frames)
+        elif name in MICRO:
+            results[name] = run_micro(MICRO[name])
+        else:
+            raise KeyError(f'No benchmark named {name}')
+    return {
+        'machine': {'python': platform.python_version(), 'numpy': np.__version__,
+                    'platform': platform.platform(), 'cpus': os.cpu_count()},
+        'results': results,
+    }
+
+
+def compare(baseline, results, threshold=THRESHOLD):
+    '''
+    Compare benchmark results with a baseline. Returns a list of (benchmark, metric, baseline time,
+    new time, relative change, regressed) tuples for the total time of each benchmark and the time of
+    each stage, where regressed means that the time grew by more than threshold.
+    '''
+    rows = []
+    for name, result in results['results'].items():
+        base = baseline['results'].get(name)
+        if base is None:
+            continue
+        metrics = [('time', base['time'], result['time'])]
+        metrics += [(stage, base['stages'][stage], result['stages'][stage])
+                    for stage in result.get('stages', {}) if stage in base.get('stages', {})]
+        for metric, old, new in metrics:
+            if max(old, new) < MIN_TIME and metric != 'time':
+                continue
+            change = new/old - 1 if old else 0.
+            rows.append((name, metric, old, new, change, change > threshold))
+    return rows
+
+
+def save(results, path):
+    '''
+    Write benchmark results to a JSON file
+    '''
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2)
+
+
+def load(path):
+    '''
+    Read benchmark results from a JSON file
+    '''
+    with open(path) as f:
+        return json.load(f)
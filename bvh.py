@@ -0,0 +1,137 @@
+import numpy as np
+
+from linalg import triangulate
+
+LEAF_SIZE = 4  # maximum number of triangles in each leaf
+DESCENT = 3  # number of levels descended at once when traversing the tree
+MORTON_BITS = 10  # bits per axis of the Morton codes used to order triangles
+EPSILON = 1.0e-12
+
+
+class BVH:
+    '''
+    Bounding volume hierarchy over the faces of a mesh, used to intersect rays with the mesh.
+    Triangles are ordered along a Morton curve and split evenly into leaves, which form the
+    bottom level of a complete binary tree of axis-aligned boxes stored in flat arrays (the
+    children of node i are nodes 2i + 1 and 2i + 2).
+    '''
+    def __init__(self, vertices, indices, offsets):
+        '''
+        vertices:   3xN or 4xN matrix of vertices
+        indices:    flat array of the vertex indices of the faces
+        offsets:    offsets at which each face starts in indices (with the total number appended)
+        '''
+        counts = np.diff(offsets)
+        triangles, _ = triangulate(indices, counts)
+        faces = np.repeat(np.arange(len(counts)), counts - 2)
+        corners = np.transpose(vertices[:3, triangles], (1, 2, 0))  # Tx3x3, (triangle, corner, axis)
+
+        # Order the triangles along a Morton curve, so that nearby triangles share leaves
+        centroids = np.mean(corners, axis=1)
+        order = np.argsort(self._morton_codes(centroids), kind='stable')
+        corners, self._faces = corners[order], faces[order]
+        self._origins = corners[:, 0]
+        self._edges = (corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0])
+
+        # Split the triangles evenly into a power of 2 leaves
+        n_triangles = len(triangles)
+        n_leaves = 1 << int(np.ceil(np.log2(max(-(-n_triangles//LEAF_SIZE), 1))))
+        self._starts = np.arange(n_leaves + 1)*n_triangles//n_leaves
+        self._n_leaves = n_leaves
+
+        # Compute the leaf boxes, then each level of parents from its children
+        lower = np.full((2*n_leaves - 1, 3), np.inf)
+        upper = np.full((2*n_leaves - 1, 3), -np.inf)
+        if n_triangles:
+            lower[n_leaves - 1:] = np.minimum.reduceat(np.min(corners, axis=1), self._starts[:-1])
+            upper[n_leaves - 1:] = np.maximum.reduceat(np.max(corners, axis=1), self._starts[:-1])
+        first = n_leaves - 1
+        while first:
+            parents = np.arange((first - 1)//2, first)
+            lower[parents] = np.minimum(lower[2*parents + 1], lower[2*parents + 2])
+            upper[parents] = np.maximum(upper[2*parents + 1], upper[2*parents + 2])
+            first = (first - 1)//2
+        self._lower, self._upper = lower, upper
+
+    @property
+    def n_triangles(self):
+        '''
+        Number of triangles in the hierarchy
+        '''
+        return len(self._faces)
+
+    def intersect(self, origin, direction, t_min=0., t_max=np.inf):
+        '''
+        Find the nearest intersection of the ray origin + t*direction with the mesh for t in
+        [t_min, t_max]. Returns a pair of t and the index of the intersected face, or None.
+        The tree is traversed a few levels at a time, testing every box the ray may reach at once.
+        '''
+        if not self.n_triangles:
+            return None
+        origin = np.asarray(origin, dtype=np.float64).ravel()[:3]
+        direction = np.asarray(direction, dtype=np.float64).ravel()[:3]
+        inverse = 1/np.where(np.abs(direction) < EPSILON, EPSILON, direction)
+
+        nodes = np.zeros(1, dtype=int)
+        levels = int(np.log2(self._n_leaves))
+        while True:
+            near = (self._lower[nodes] - origin)*inverse
+            far = (self._upper[nodes] - origin)*inverse
+            enter = np.max(np.minimum(near, far), axis=1)
+            exit = np.min(np.maximum(near, far), axis=1)
+            nodes = nodes[(enter <= exit) & (exit >= t_min) & (enter <= t_max)]
+            if not len(nodes) or not levels:
+                break
+            # The descendants of node i which are k levels below it are nodes (i + 1)*2^k - 1 onwards
+            descent = min(DESCENT, levels)
+            levels -= descent
+            nodes = (((nodes + 1) << descent) - 1).reshape((-1, 1)) + np.arange(1 << descent)
+            nodes = nodes.ravel()
+        if not len(nodes):
+            return None
+
+        # Intersect the ray with every triangle in the reached leaves
+        leaves = nodes - (self._n_leaves - 1)
+        sizes = self._starts[leaves + 1] - self._starts[leaves]
+        triangles = np.repeat(self._starts[leaves] - np.cumsum(sizes) + sizes, sizes) + np.arange(np.sum(sizes))
+        t = self._intersect_triangles(triangles, origin, direction)
+        t[(t < t_min) | (t > t_max)] = np.nan
+        if np.all(np.isnan(t)):
+            return None
+        nearest = np.nanargmin(t)
+        return t[nearest], int(self._faces[triangles[nearest]])
+
+    def _intersect_triangles(self, triangles, origin, direction):
+        '''
+        Intersect a ray with triangles using the Moller-Trumbore algorithm. Returns the ray parameter
+        of each intersection, or NaN for triangles which the ray misses.
+        '''
+        edge1, edge2 = self._edges[0][triangles], self._edges[1][triangles]
+        p = np.cross(direction, edge2)
+        det = np.einsum('ij,ij->i', edge1, p)
+        valid = np.abs(det) > EPSILON
+        inv_det = 1/np.where(valid, det, 1)
+        s = origin - self._origins[triangles]
+        u = np.einsum('ij,ij->i', s, p)*inv_det
+        q = np.cross(s, edge1)
+        v = np.dot(q, direction)*inv_det
+        t = np.einsum('ij,ij->i', q, edge2)*inv_det
+        hit = valid & (u >= 0) & (v >= 0) & (u + v <= 1)
+        return np.where(hit, t, np.nan)
+
+    @staticmethod
+    def _morton_codes(points):
+        '''
+        Morton codes of an Nx3 array of points, interleaving the bits of their quantized coordinates
+        within the points' bounding box
+        '''
+        if not len(points):
+            return np.zeros(0, dtype=np.int64)
+        lower, upper = np.min(points, axis=0), np.max(points, axis=0)
+        scale = ((1 << MORTON_BITS) - 1)/np.maximum(upper - lower, EPSILON)
+        cells = ((points - lower)*scale).astype(np.int64)
+        codes = np.zeros(len(points), dtype=np.int64)
+        for bit in range(MORTON_BITS):
+            for axis in range(3):
+                codes |= ((cells[:, axis] >> bit) & 1) << (3*bit + axis)
+        return codes
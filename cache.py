@@ -0,0 +1,109 @@
+import os
+import hashlib
+import tempfile
+import numpy as np
+
+from models import MESH_VERSION
+
+HASH_CHUNK_SIZE = 2**20
+ARRAYS = ('vertices', 'faces')
+
+
+class MeshCache:
+    '''
+    Persistent cache of processed meshes (vertex and face arrays) on disk
+    '''
+    def __init__(self, directory, max_size=512*2**20):
+        '''
+        directory:  directory in which cached meshes are stored (created if it does not exist)
+        max_size:   maximum total size of the cache in bytes, after which the least recently
+                    used meshes are evicted
+        '''
+        self._directory = directory
+        self._max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, file):
+        '''
+        Cache key of a mesh file, from the hash of its contents and the mesh processing version
+        '''
+        digest = hashlib.sha256()
+        with open(file, 'rb') as f:
+            for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+                digest.update(chunk)
+        return f'{digest.hexdigest()}-v{MESH_VERSION}'
+
+    def load(self, key):
+        '''
+        Load a cached mesh as a pair of memory-mapped vertex and face arrays, or return None
+        if the mesh is not in the cache
+        '''
+        paths = self._paths(key)
+        try:
+            arrays = tuple(np.load(path, mmap_mode='r') for path in paths)
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+        for path in paths:
+            os.utime(path)
+        self.hits += 1
+        return arrays
+
+    def store(self, key, vertices, faces):
+        '''
+        Store a mesh in the cache, evicting older meshes if the cache is too large
+        '''
+        for path, array in zip(self._paths(key), (vertices, faces)):
+            # Write to a temporary file first so that partially written arrays are never loaded
+            fd, tmp_path = tempfile.mkstemp(dir=self._directory, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                np.save(f, np.ascontiguousarray(array))
+            os.replace(tmp_path, path)
+        self._evict()
+
+    def clear(self):
+        '''
+        Remove all meshes from the cache
+        '''
+        for entry in self._entries():
+            os.remove(entry.path)
+
+    @property
+    def size(self):
+        '''
+        Total size of the cached meshes in bytes
+        '''
+        return sum(entry.stat().st_size for entry in self._entries())
+
+    def _paths(self, key):
+        '''
+        Paths of the array files of a cached mesh
+        '''
+        return [os.path.join(self._directory, f'{key}.{name}.npy') for name in ARRAYS]
+
+    def _entries(self):
+        '''
+        Array files in the cache directory
+        '''
+        return [entry for entry in os.scandir(self._directory) if entry.name.endswith('.npy')]
+
+    def _evict(self):
+        '''
+        Remove the least recently used meshes until the cache fits within its maximum size
+        '''
+        meshes = {}
+        for entry in self._entries():
+            stat = entry.stat()
+            key = entry.name.split('.')[0]
+            size, used = meshes.get(key, (0, 0))
+            meshes[key] = (size + stat.st_size, max(used, stat.st_mtime))
+        total = sum(size for size, _ in meshes.values())
+        for key in sorted(meshes, key=lambda k: meshes[k][1]):
+            if total <= self._max_size:
+                break
+            for path in self._paths(key):
+                if os.path.exists(path):
+                    os.remove(path)
+            total -= meshes[key][0]
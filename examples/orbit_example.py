@@ -44,11 +44,10 @@ def cube2_position(time):
 
 def cube3_position(time):
     '''
-    Make cube3 orbit cube2
+    Make cube3 orbit cube2 (relative to cube2, its parent)
     '''
-    xc, yc, zc = cube2_position(time)
-    xr, yr, zr = xz_circular_motion(time, 3, 1)
-    return xc + xr, yc + yr, zc - zr
+    x, y, z = xz_circular_motion(time, 3, 1)
+    return x, y, -z
 
 
 def cube4_position(time):
@@ -61,23 +60,25 @@ def cube4_position(time):
 
 def cube5_position(time):
     '''
-    Make cube5 orbit cube4
+    Make cube5 orbit cube4 (relative to cube4, its parent)
     '''
-    xc, yc, zc = cube4_position(time)
-    xr, yr, zr = xz_circular_motion(time, 10, 0.15)
-    return xc + xr, yc + yr, zc + zr
+    return xz_circular_motion(time, 10, 0.15)
 
 
-def main():
+def build_scene():
+    '''
+    Create the example's models, motions and Scene
+    '''
     # Instantiate manager
     manager = ModelManager()
 
-    # Create box models
-    manager.add_model('cube1', vertices=BOX['vertices'], faces=BOX['faces'])
-    manager.add_model('cube2', vertices=BOX['vertices'], faces=BOX['faces'])
-    manager.add_model('cube3', vertices=BOX['vertices'], faces=BOX['faces'])
-    manager.add_model('cube4', vertices=BOX['vertices'], faces=BOX['faces'])
-    manager.add_model('cube5', vertices=BOX['vertices'], faces=BOX['faces'])
+    # Create box models sharing a single mesh
+    manager.add_mesh('box', vertices=BOX['vertices'], faces=BOX['faces'])
+    manager.add_model('cube1', mesh='box')
+    manager.add_model('cube2', mesh='box')
+    manager.add_model('cube3', mesh='box')
+    manager.add_model('cube4', mesh='box')
+    manager.add_model('cube5', mesh='box')
 
     # Recolour cubes
     manager.set_colour('cube1', (255, 255, 255))
@@ -92,6 +93,8 @@ def main():
     manager.scale('cube4', 2)
 
     # Add motion to the models (box1 is stationary)
+    manager.set_parent('cube3', 'cube2')
+    manager.set_parent('cube5', 'cube4')
     manager.add_motion('cube2', positions=cube2_position)
     manager.add_motion('cube3', positions=cube3_position)
     manager.add_motion('cube4', positions=cube4_position)
@@ -106,8 +109,11 @@ def main():
 
     # Add manager to scene
     scene.add_manager(manager)
+    return scene
+
 
-    # Run scene
+def main():
+    scene = build_scene()
     scene.run()
 
 
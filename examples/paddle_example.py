@@ -21,7 +21,10 @@ def get_data(filename, headersize=0):
     return cols
 
 
-def main():
+def build_scene():
+    '''
+    Create the example's models, motions and Scene
+    '''
     # Instantiate manager
     manager = ModelManager()
 
@@ -54,8 +57,11 @@ def main():
 
     # Add manager to scene
     scene.add_manager(manager)
+    return scene
+
 
-    # Run scene
+def main():
+    scene = build_scene()
     scene.run(duration=60)
 
 
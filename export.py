@@ -0,0 +1,267 @@
+import io
+import os
+import pickle
+import shutil
+import subprocess
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import pygame
+
+CHUNK_FRAMES = 8  # number of consecutive frames rendered by a worker at once
+IN_FLIGHT = 2  # number of chunks queued per worker, which bounds the frames held in memory
+VIDEO_FORMATS = ('.mp4', '.mkv', '.avi', '.mov', '.webm')
+GIF_MAX_CODE = 4095  # largest LZW code in a GIF
+
+_worker = {}  # scene and frame encoder of a worker process
+
+
+class ImageSequenceWriter:
+    '''
+    Writes frames as a sequence of numbered PNG images. path is a directory, a pattern such as
+    'frames/frame_{:05d}.png', or a .png file name to which the frame number is appended.
+    '''
+    def __init__(self, path, size, fps):
+        path = Path(path)
+        if path.suffix.lower() == '.png':
+            name = path.name if '{' in path.name else f'{path.stem}_{{:05d}}.png'
+            path = path.parent
+        else:
+            name = 'frame_{:05d}.png'
+        path.mkdir(parents=True, exist_ok=True)
+        self._pattern = str(path.joinpath(name))
+        self._n_frames = 0
+
+    @staticmethod
+    def encode(frame):
+        '''
+        Encode an HxWx3 frame as a PNG image
+        '''
+        data = io.BytesIO()
+        pygame.image.save(pygame.surfarray.make_surface(np.transpose(frame, (1, 0, 2))), data, 'png')
+        return data.getvalue()
+
+    def write(self, data):
+        with open(self._pattern.format(self._n_frames), 'wb') as f:
+            f.write(data)
+        self._n_frames += 1
+
+    def close(self):
+        pass
+
+
+class GifWriter:
+    '''
+    Writes frames to an animated GIF which loops forever. Each frame has its own colour table, holding
+    its colours exactly if it has at most 256 of them and a 3-3-2 bit quantization of them otherwise.
+    '''
+    def __init__(self, path, size, fps):
+        self._file = open(path, 'wb')
+        self._fps = fps
+        self._n_frames = 0
+        width, height = size
+        self._file.write(b'GIF89a' + _uint16(width) + _uint16(height) + bytes((0x70, 0, 0)))
+        self._file.write(b'\x21\xff\x0bNETSCAPE2.0\x03\x01\x00\x00\x00')
+
+    @staticmethod
+    def encode(frame):
+        '''
+        Encode an HxWx3 frame as a GIF image descriptor, local colour table and LZW image data
+        '''
+        height, width = frame.shape[:2]
+        rgb = frame.reshape((-1, 3)).astype(np.int32)
+        colours, indices = np.unique((rgb[:, 0] << 16) | (rgb[:, 1] << 8) | rgb[:, 2], return_inverse=True)
+        if len(colours) > 256:
+            colours, indices = np.unique((rgb[:, 0] >> 5 << 5) | (rgb[:, 1] >> 5 << 2) | (rgb[:, 2] >> 6),
+                                         return_inverse=True)
+            palette = np.stack(((colours >> 5)*255//7, (colours >> 2 & 7)*255//7, (colours & 3)*255//3), axis=1)
+        else:
+            palette = np.stack((colours >> 16, colours >> 8 & 255, colours & 255), axis=1)
+        bits = max(int(np.ceil(np.log2(len(colours)))), 1)
+        table = np.zeros((1 << bits, 3), dtype=np.uint8)
+        table[:len(palette)] = palette
+
+        min_code_size = max(bits, 2)
+        data = _lzw_encode(indices.ravel().tolist(), min_code_size)
+        blocks = b''.join(bytes((len(data[i:i + 255]),)) + data[i:i + 255] for i in range(0, len(data), 255))
+        return (b'\x2c' + _uint16(0) + _uint16(0) + _uint16(width) + _uint16(height) + bytes((0x80 | (bits - 1),))
+                + table.tobytes() + bytes((min_code_size,)) + blocks + b'\x00')
+
+    def write(self, data):
+        # Delays are in hundredths of a second, rounded so that they don't drift from the frame rate
+        delay = round((self._n_frames + 1)*100/self._fps) - round(self._n_frames*100/self._fps)
+        self._file.write(b'\x21\xf9\x04\x00' + _uint16(delay) + b'\x00\x00' + data)
+        self._n_frames += 1
+
+    def close(self):
+        self._file.write(b'\x3b')
+        self._file.close()
+
+
+class FfmpegWriter:
+    '''
+    Writes frames to a video by piping them as raw RGB frames to ffmpeg, which must be installed
+    '''
+    def __init__(self, path, size, fps):
+        ffmpeg = shutil.which('ffmpeg')
+        if ffmpeg is None:
+            raise RuntimeError('ffmpeg was not found, so videos cannot be written')
+        width, height = size
+        command = [ffmpeg, '-loglevel', 'error', '-y', '-f', 'rawvideo', '-pix_fmt', 'rgb24',
+                   '-s', f'{width}x{height}', '-r', str(fps), '-i', '-', '-pix_fmt', 'yuv420p', str(path)]
+        self._process = subprocess.Popen(command, stdin=subprocess.PIPE)
+
+    @staticmethod
+    def encode(frame):
+        '''
+        Encode an HxWx3 frame as raw RGB bytes
+        '''
+        return np.ascontiguousarray(frame).tobytes()
+
+    def write(self, data):
+        self._process.stdin.write(data)
+
+    def close(self):
+        self._process.stdin.close()
+        if self._process.wait():
+            raise RuntimeError(f'ffmpeg failed with exit code {self._process.returncode}')
+
+
+def get_writer(path):
+    '''
+    Get the writer class for a path: GifWriter for .gif files, FfmpegWriter for video files and
+    ImageSequenceWriter for .png files and directories
+    '''
+    suffix = Path(path).suffix.lower()
+    if suffix == '.gif':
+        return GifWriter
+    if suffix in VIDEO_FORMATS:
+        return FfmpegWriter
+    if suffix in ('.png', ''):
+        return ImageSequenceWriter
+    raise ValueError(f'Cannot export frames to {suffix} files')
+
+
+def export_animation(scene, path, t0, t1, fps, processes=None, build_manager=None):
+    '''
+    Render the frames of a Scene at times t0, t0 + 1/fps, ... before t1 and write them in order to
+    path (see get_writer). The frames are split into chunks of consecutive frames which are rendered
+    and encoded by a pool of processes (os.cpu_count() by default). Each worker rebuilds the Scene's
+    ModelManager, either by calling build_manager or from a pickled copy of the manager, so motion
+    functions must be picklable if build_manager is not given. Only a few chunks are queued per
+    worker, so memory use doesn't grow with the number of frames. If processes is 1, frames are
+    rendered in this process instead.
+    '''
+    if fps <= 0:
+        raise ValueError('Frame rate must be positive')
+    if t1 <= t0:
+        raise ValueError('End time must be after start time')
+    times = t0 + np.arange(int(np.ceil((t1 - t0)*fps - 1e-9)))/fps
+    writer_class = get_writer(path)
+    processes = os.cpu_count() if processes is None else processes
+
+    if processes == 1:
+        writer = writer_class(path, scene.get_screen_size(), fps)
+        try:
+            for frame in scene.render_frames(times):
+                writer.write(writer_class.encode(frame))
+        finally:
+            writer.close()
+        return
+
+    try:
+        manager = None if build_manager is not None else pickle.dumps(scene.get_manager())
+    except (pickle.PicklingError, AttributeError, TypeError) as e:
+        raise TypeError('The ModelManager cannot be pickled (e.g. it has lambda motions), '
+                        'so build_manager must be given') from e
+    chunks = [times[i:i + CHUNK_FRAMES] for i in range(0, len(times), CHUNK_FRAMES)]
+    writer = writer_class(path, scene.get_screen_size(), fps)
+    try:
+        with ProcessPoolExecutor(processes, initializer=_initialize_worker,
+                                 initargs=(pickle.dumps(scene), manager, build_manager, writer_class)) as pool:
+            pending = deque()
+            chunks = iter(chunks)
+            for chunk in chunks:
+                pending.append(pool.submit(_render_chunk, chunk))
+                if len(pending) >= IN_FLIGHT*processes:
+                    break
+            while pending:
+                for data in pending.popleft().result():
+                    writer.write(data)
+                chunk = next(chunks, None)
+                if chunk is not None:
+                    pending.append(pool.submit(_render_chunk, chunk))
+    finally:
+        writer.close()
+
+
+def _initialize_worker(scene, manager, build_manager, writer_class):
+    '''
+    Rebuild the Scene and its ModelManager in a worker process
+    '''
+    scene = pickle.loads(scene)
+    scene.add_manager(build_manager() if build_manager is not None else pickle.loads(manager))
+    _worker['scene'] = scene
+    _worker['encode'] = writer_class.encode
+
+
+def _render_chunk(times):
+    '''
+    Render and encode frames in a worker process
+    '''
+    return [_worker['encode'](frame) for frame in _worker['scene'].render_frames(times)]
+
+
+def _uint16(value):
+    '''
+    Little-endian bytes of a 16-bit unsigned integer
+    '''
+    return int(value).to_bytes(2, 'little')
+
+
+def _lzw_encode(indices, min_code_size):
+    '''
+    Compress a list of colour indices with the variable-length LZW coding used by GIF images
+    '''
+    clear = 1 << min_code_size
+    code_size = min_code_size + 1
+    max_code = clear + 1
+    table = {}
+    out = bytearray()
+    buffer, n_bits = clear, code_size  # codes are packed least significant bit first
+    code = indices[0]
+    for index in indices[1:]:
+        key = code << 8 | index
+        if key in table:
+            code = table[key]
+            continue
+        buffer |= code << n_bits
+        n_bits += code_size
+        max_code += 1
+        table[key] = max_code
+        if max_code >= 1 << code_size:
+            code_size += 1
+        if max_code == GIF_MAX_CODE:
+            buffer |= clear << n_bits
+            n_bits += code_size
+            table = {}
+            code_size = min_code_size + 1
+            max_code = clear + 1
+        code = index
+        while n_bits >= 8:
+            out.append(buffer & 255)
+            buffer >>= 8
+            n_bits -= 8
+    buffer |= code << n_bits
+    n_bits += code_size
+    buffer |= clear << n_bits
+    n_bits += code_size
+    buffer |= (clear + 1) << n_bits
+    n_bits += min_code_size + 1
+    while n_bits > 0:
+        out.append(buffer & 255)
+        buffer >>= 8
+        n_bits -= 8
+    return bytes(out)
@@ -21,21 +21,39 @@ def vector(vec, w=None):
 
 def vector_matrix(vectors, w=None):
     '''
-    A matrix of column vectors
+    A matrix of column vectors (vectors may be an iterable of vectors or an Nx3 array)
     '''
-    return np.hstack((vector(v, w) for v in vectors))
+    if not isinstance(vectors, np.ndarray):
+        vectors = list(vectors)
+    matrix = np.array(vectors, dtype=np.float64).reshape((-1, 3)).T
+    if w is not None:
+        matrix = np.vstack((matrix, np.full(matrix.shape[1], w, dtype=np.float64)))
+    return matrix
 
 
 def unit_vector_matrix(vectors, w=None):
     '''
     A matrix of normalized column vectors
     '''
-    matrix = np.hstack((vector(v) / np.linalg.norm(v) for v in vectors))
+    matrix = np.hstack([vector(v) / np.linalg.norm(v) for v in vectors])
     if w is not None:
         matrix = np.vstack((matrix, w*np.ones(matrix.shape[1])))
     return matrix
 
 
+def face_normals(vertices, indices, offsets):
+    '''
+    3xF matrix of the unit normals of faces described by the indices of their vertices (3xN matrix),
+    given as a flat array of indices and the offsets at which each face starts. Normals follow the
+    right-hand rule on the first three vertices of each face.
+    '''
+    faces = indices[offsets[:-1].reshape((-1, 1)) + np.arange(3)]
+    normals = np.cross(vertices[:3, faces[:, 1]] - vertices[:3, faces[:, 0]],
+                       vertices[:3, faces[:, 2]] - vertices[:3, faces[:, 0]], axis=0)
+    norms = np.linalg.norm(normals, axis=0)
+    return normals/np.where(norms > ORTH_EPSILON, norms, 1)
+
+
 def rotation_matrix(point, direction, angle):
     '''
     4x4 matrix to rotate about the line defined by the given point and direction
@@ -67,6 +85,57 @@ def project2d(point, center, projection):
     return center[0] + int(point[0]/point[2]*projection[0]), center[1] + int(point[1]/point[2]*projection[1])
 
 
+def project_points(points, center, projection, discrete=True):
+    '''
+    Projection of a 3xN matrix of 3D points onto a 2D plane (vectorized project2d).
+    If discrete is False, the projected points are not truncated to integers.
+    '''
+    x = points[0]/points[2]*projection[0]
+    y = points[1]/points[2]*projection[1]
+    if discrete:
+        x, y = np.trunc(x).astype(int), np.trunc(y).astype(int)
+    return np.vstack((center[0] + x, center[1] + y))
+
+
+def triangulate(indices, counts):
+    '''
+    Split polygons (given as flattened vertex indices and the number of vertices in each polygon)
+    into triangles fanning out from each polygon's first vertex. Returns a Tx3 array of vertex indices
+    and a Tx3 boolean array indicating which triangle edges ((v0, v1), (v1, v2), (v2, v0)) are polygon edges.
+    '''
+    n_triangles = counts - 2
+    polygon = np.repeat(np.arange(len(counts)), n_triangles)
+    starts = np.cumsum(counts) - counts
+    corner = np.arange(len(polygon)) - np.repeat(np.cumsum(n_triangles) - n_triangles, n_triangles) + 1
+    triangles = np.stack((indices[starts[polygon]], indices[starts[polygon] + corner],
+                          indices[starts[polygon] + corner + 1]), axis=1)
+    edges = np.stack((corner == 1, np.ones(len(polygon), dtype=bool), corner == counts[polygon] - 2), axis=1)
+    return triangles, edges
+
+
+def view_matrix(viewpoint, rotation):
+    '''
+    4x4 matrix to convert world coordinates to the coordinates of a camera at the given
+    viewpoint, rotated first about its y-axis by rotation[1] and then about its x-axis by rotation[0]
+    '''
+    cos_x, sin_x = np.cos(rotation[0]), np.sin(rotation[0])
+    cos_y, sin_y = np.cos(rotation[1]), np.sin(rotation[1])
+    rot_y = np.array([
+        [cos_y, 0, -sin_y, 0],
+        [0, 1, 0, 0],
+        [sin_y, 0, cos_y, 0],
+        [0, 0, 0, 1]
+    ]).astype(np.float64)
+    rot_x = np.array([
+        [1, 0, 0, 0],
+        [0, cos_x, -sin_x, 0],
+        [0, sin_x, cos_x, 0],
+        [0, 0, 0, 1]
+    ]).astype(np.float64)
+    viewpoint = np.ravel(viewpoint)
+    return np.matmul(rot_x, np.matmul(rot_y, translation_matrix(-viewpoint[0], -viewpoint[1], -viewpoint[2])))
+
+
 def translation_matrix(dx, dy, dz):
     '''
     4x4 translation matrix
@@ -74,7 +143,16 @@ def translation_matrix(dx, dy, dz):
     return np.hstack((np.vstack((np.identity(3), np.zeros(3))), vector((dx, dy, dz), w=1)))
 
 
-def basis_matrix(basis):
+def basis_matrix(basis, check=True):
+    '''
+    4x4 matrix whose columns are the given basis vectors. If check is False, the vectors are
+    trusted to form a right-handed orthonormal basis (e.g. from oriented_bases) and are used as given.
+    '''
+    if not check:
+        matrix = np.zeros((4, 4))
+        matrix[:3, :3] = np.asarray(basis, dtype=np.float64).reshape((3, 3)).T
+        matrix[3, 3] = 1
+        return matrix
     if is_orthogonal_basis(basis[0], basis[1], basis[2]):
         return np.hstack((unit_vector_matrix(basis, w=0), vector((0, 0, 0), w=1)))
     else:
@@ -99,12 +177,91 @@ def oriented_basis(yaw=0, pitch=0, roll=0):
     '''
     Transform a space to a diferent orientation
     '''
-    # Create global basis
-    basis_mat = unit_vector_matrix((XAXIS, YAXIS, ZAXIS), w=0)
+    return [tuple(v) for v in oriented_bases(((yaw, pitch, roll),))[0]]
+
+
+def oriented_bases(orientations):
+    '''
+    Vectorized oriented_basis. Converts an Nx3 array of yaw-pitch-roll angles to an Nx3x3 array of
+    bases, the rows of each basis being its vectors. The global basis is rotated about its z-axis by
+    the yaw, then about its new x-axis by the pitch and its new y-axis by the roll.
+    '''
+    angles = np.asarray(orientations, dtype=np.float64).reshape((-1, 3))
+    cos_a, cos_b, cos_c = np.cos(angles).T
+    sin_a, sin_b, sin_c = np.sin(angles).T
+    # Rows of Rz(yaw) Rx(pitch) Ry(roll) transposed, i.e. the rotated basis vectors
+    return np.stack((
+        np.stack((cos_a*cos_c - sin_a*sin_b*sin_c, sin_a*cos_c + cos_a*sin_b*sin_c, -cos_b*sin_c), axis=1),
+        np.stack((-sin_a*cos_b, cos_a*cos_b, sin_b), axis=1),
+        np.stack((cos_a*sin_c + sin_a*sin_b*cos_c, sin_a*sin_c - cos_a*sin_b*cos_c, cos_b*cos_c), axis=1)
+    ), axis=1)
+
+
+def euler_to_quaternion(angles):
+    '''
+    Convert an Nx3 array of yaw-pitch-roll angles (see oriented_basis) to an Nx4 array of unit
+    quaternions (w, x, y, z). The rotations are about the z, x and y axes, in that order.
+    '''
+    half = np.asarray(angles, dtype=np.float64).reshape((-1, 3))/2
+    cos, sin = np.cos(half), np.sin(half)
+    zeros = np.zeros(len(half))
+    yaw = np.stack((cos[:, 0], zeros, zeros, sin[:, 0]), axis=1)
+    pitch = np.stack((cos[:, 1], sin[:, 1], zeros, zeros), axis=1)
+    roll = np.stack((cos[:, 2], zeros, sin[:, 2], zeros), axis=1)
+    return quaternion_multiply(quaternion_multiply(yaw, pitch), roll)
 
-    # Perform rotations
-    basis_mat = rotate_basis(basis_mat, basis_mat[:3, 2], yaw)
-    basis_mat = rotate_basis(basis_mat, basis_mat[:3, 0], pitch)
-    basis_mat = rotate_basis(basis_mat, basis_mat[:3, 1], roll)
 
-    return [tuple(basis_mat[:3, i]) for i in range(3)]
+def quaternion_to_euler(quaternions):
+    '''
+    Convert an Nx4 array of unit quaternions (w, x, y, z) to an Nx3 array of yaw-pitch-roll angles
+    '''
+    # Only the rotation matrix elements needed to recover the angles are computed (see quaternion_matrix)
+    w, x, y, z = np.asarray(quaternions, dtype=np.float64).reshape((-1, 4)).T
+    yaw = np.arctan2(2*(w*z - x*y), 1 - 2*(x*x + z*z))
+    pitch = np.arcsin(np.clip(2*(y*z + w*x), -1, 1))
+    roll = np.arctan2(2*(w*y - x*z), 1 - 2*(x*x + y*y))
+    return np.stack((yaw, pitch, roll), axis=1)
+
+
+def quaternion_multiply(q1, q2):
+    '''
+    Products of two Nx4 arrays of quaternions (w, x, y, z)
+    '''
+    w1, x1, y1, z1 = np.moveaxis(q1, -1, 0)
+    w2, x2, y2, z2 = np.moveaxis(q2, -1, 0)
+    return np.stack((w1*w2 - x1*x2 - y1*y2 - z1*z2,
+                     w1*x2 + x1*w2 + y1*z2 - z1*y2,
+                     w1*y2 - x1*z2 + y1*w2 + z1*x2,
+                     w1*z2 + x1*y2 - y1*x2 + z1*w2), axis=-1)
+
+
+def quaternion_matrix(quaternions):
+    '''
+    Nx3x3 array of the rotation matrices of an Nx4 array of unit quaternions (w, x, y, z)
+    '''
+    w, x, y, z = np.moveaxis(quaternions, -1, 0)
+    return np.stack((
+        np.stack((1 - 2*(y*y + z*z), 2*(x*y - w*z), 2*(x*z + w*y)), axis=-1),
+        np.stack((2*(x*y + w*z), 1 - 2*(x*x + z*z), 2*(y*z - w*x)), axis=-1),
+        np.stack((2*(x*z - w*y), 2*(y*z + w*x), 1 - 2*(x*x + y*y)), axis=-1)
+    ), axis=-2)
+
+
+def slerp(q1, q2, fraction):
+    '''
+    Spherical linear interpolation between two Nx4 arrays of unit quaternions, taking the shorter
+    path between each pair. fraction is an array of N interpolation fractions between 0 and 1.
+    '''
+    fraction = np.asarray(fraction, dtype=np.float64).reshape((-1, 1))
+    dot = np.sum(q1*q2, axis=-1, keepdims=True)
+    q2 = np.where(dot < 0, -q2, q2)
+    dot = np.clip(np.abs(dot), 0, 1)
+    angle = np.arccos(dot)
+    sin = np.sin(angle)
+    # Nearly identical rotations are interpolated linearly to avoid dividing by zero
+    close = sin < ORTH_EPSILON
+    sin = np.where(close, 1, sin)
+    w1 = np.where(close, 1 - fraction, np.sin((1 - fraction)*angle)/sin)
+    w2 = np.where(close, fraction, np.sin(fraction*angle)/sin)
+    result = w1*q1 + w2*q2
+    return result/np.linalg.norm(result, axis=-1, keepdims=True)
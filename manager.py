@@ -1,21 +1,48 @@
-from models import Model, MotionMap
-from linalg import vector, oriented_basis
+import numpy as np
+
+from models import Mesh, Model, MotionMap, TransformStore
+from linalg import vector, oriented_bases
 
 
 class ModelManager:
     '''
     Controls a set of models
     '''
-    def __init__(self):
+    def __init__(self, mesh_cache=None, contiguous=False):
+        '''
+        mesh_cache: optional MeshCache used to load models from STL files
+        contiguous: if True, the origins, bases and transforms of all models are kept in contiguous
+                    arrays (see TransformStore), and motion is applied to all models at once
+        '''
+        self._mesh_cache = mesh_cache
+        self._store = TransformStore() if contiguous else None
+        self._slots = {}  # slot of each model in the TransformStore
         self._models = {}
+        self._meshes = {}
         self._motions = {}
+        self._applied_states = {}  # last state applied to each model, and the model's version after
+        self._baked = None  # motion tables sampled by bake_motions
+        self._parents = {}
+        self._levels = None  # child models grouped by depth in the hierarchy (see _hierarchy_levels)
+        self._world = {}  # world transform of each child model, with the versions it was computed from
+        self._world_vertices = {}  # cached world vertices of each child model (see get_vertex_array)
+        self._world_stamp = 0  # stamp of the last world transform computed
+        self._baked_keys = {}  # index of each model in the motion tables
+        self._version = 0  # incremented when models are added or removed, recoloured or reparented
+        self._motions_version = 0  # incremented when models, motions or parents change
+        self._snapshot_plans = (None, {})  # snapshot plans and the motions version they were made at
+        self._slot_cache = (None, [], None)  # version, keys and slots of the last keys looked up
 
     def add_model(self, key, **kwargs):
         '''
-        Register a new model. Models may be passed in three ways via keyword args:
+        Register a new model. Models may be passed in four ways via keyword args:
             model:              pass in a Model object
+            mesh:               pass in the name of a registered mesh (see add_mesh) or a Mesh object,
+                                which is shared with any other models using it
             stl_file:           pass in an STL file to create the model from
             vertices, faces:    pass in a list of vertices (required) and a list of faces (optional)
+        When creating the model from an STL file or vertices and faces, lod_levels may also be passed
+        to build simplified meshes which are drawn when the model is small on screen (see Mesh.build_lods).
         '''
         if key in self._models:
             raise KeyError(f'A model already exists with key {key}')
@@ -24,29 +51,106 @@ class ModelManager:
             if not isinstance(model, Model):
                 raise TypeError(f'Model of type {type(model).__name__} cannot be added')
         else:
-            stl_file = kwargs.get('stl_file', None)
-            if stl_file is not None:
-                model = Model.from_stl(stl_file)
-            else:
-                vertices = kwargs.get('vertices', None)
-                if vertices is not None:
-                    model = Model(vertices=vertices)
-                    faces = kwargs.get('faces', None)
-                    if faces is not None:
-                        model.faces = faces
+            mesh = kwargs.get('mesh', None)
+            if mesh is None:
+                mesh = self._create_mesh(**kwargs)
+            elif not isinstance(mesh, Mesh):
+                mesh = self._meshes[mesh]
+            if mesh is not None:
+                model = Model(mesh=mesh)
         if model is None:
             raise ValueError('Could not construct a model from the given inputs')
+        if self._store is not None:
+            self._slots[key] = self._store.add(model.space)
         self._models[key] = model
+        self._version += 1
+        self._motions_version += 1
+
+    def add_mesh(self, name, **kwargs):
+        '''
+        Register a mesh which can be shared by many models, each with its own position, orientation,
+        scale and colour (see add_model). Meshes may be passed in three ways via keyword args:
+            mesh:               pass in a Mesh object
+            stl_file:           pass in an STL file to create the mesh from
+            vertices, faces:    pass in a list of vertices (required) and a list of faces (optional)
+        As in add_model, lod_levels may be passed to build simplified versions of a new mesh.
+        '''
+        if name in self._meshes:
+            raise KeyError(f'A mesh already exists with name {name}')
+        mesh = kwargs.get('mesh', None)
+        if mesh is not None:
+            if not isinstance(mesh, Mesh):
+                raise TypeError(f'Mesh of type {type(mesh).__name__} cannot be added')
+        else:
+            mesh = self._create_mesh(**kwargs)
+        if mesh is None:
+            raise ValueError('Could not construct a mesh from the given inputs')
+        self._meshes[name] = mesh
+
+    def remove_mesh(self, name):
+        '''
+        Remove a mesh from the manager. Models which already use the mesh keep it.
+        '''
+        del self._meshes[name]
 
     def remove_model(self, key):
         '''
         Remove a model from the manager
         '''
+        if self._store is not None:
+            self._store.remove(self._models[key].space)
+            del self._slots[key]
+        for child in self.get_children(key):
+            self.set_parent(child, None)
+        self.set_parent(key, None)
         del self._models[key]
+        self._version += 1
         if key in self._motions:
             del self._motions[key]
+        self._applied_states.pop(key, None)
+        self._baked_keys.pop(key, None)
+        self._motions_version += 1
+
+    def set_parent(self, key, parent):
+        '''
+        Attach a model to a parent model, or detach it if parent is None. The position, orientation
+        and motion of a child model are relative to its parent's position and orientation (but not
+        its parent's scale or local basis), so that the child follows its parent. Children of a removed
+        model become top-level models.
+        '''
+        if key not in self._models:
+            raise KeyError(f'No model exists with key {key}')
+        if parent is not None:
+            if parent not in self._models:
+                raise KeyError(f'No model exists with key {parent}')
+            ancestor = parent
+            while ancestor is not None:
+                if ancestor == key:
+                    raise ValueError(f'Model {key} cannot be a descendant of itself')
+                ancestor = self._parents.get(ancestor)
+            self._parents[key] = parent
+        else:
+            self._parents.pop(key, None)
+        self._world.pop(key, None)
+        self._world_vertices.pop(key, None)
+        self._levels = None
+        self._version += 1
+        self._motions_version += 1
 
-    def add_motion(self, key, positions=(), orientations=(), times=()):
+    def get_parent(self, key):
+        '''
+        Get the key of a model's parent, or None if it has no parent
+        '''
+        return self._parents.get(key)
+
+    def get_children(self, key):
+        '''
+        Get the keys of a model's children
+        '''
+        return [child for child, parent in self._parents.items() if parent == key]
+
+    def add_motion(self, key, positions=(), orientations=(), times=(), interpolation='step',
+                   vectorized=False):
         '''
         Add motion to a model. Motion can be specified as:
             a) List of positions, orientations, and times
@@ -56,21 +160,75 @@ class ModelManager:
                 both be passed as nx3 iterables - for positions, the 3 is x-y-z, and for orientations,
                 the 3 is yaw-pitch-roll. Note that rotations are done in the order yaw-pitch-roll about
                 the z, x, and y axes of the object respectively, with resepct to the world basis.
+                By default, each state is held until the next time. Passing interpolation='linear'
+                interpolates linearly between states instead, while 'slerp' also interpolates
+                orientations along the shortest rotation between them. States can be looked up
+                at any time, in any order.
             b) Functional relationships
                 In this case, positions and orientations are passed as functions of time. The functions
                 must only take a single argument (time), and must return a 3-element iterable in both cases.
-                See case a) for a description of the 3 elements.
+                See case a) for a description of the 3 elements. If vectorized is True, the functions
+                must also accept an array of times, returning 3 elements which are each an array of
+                values parallel to the times or a single value. bake_motions then calls them once with
+                all sample times rather than once per sample.
         Note that in both cases, positions and orientations can be passed independently (i.e.
         one may pass in an argument for positions, but not orientations). Also note that adding motion
         implies replacing any existing motion, as motions do not stack.
         '''
-        self._motions[key] = MotionMap(positions, orientations, times)
+        self._motions[key] = MotionMap(positions, orientations, times, interpolation, vectorized)
+        self._baked_keys.pop(key, None)
+        self._motions_version += 1
 
     def remove_motion(self, key):
         '''
         Remove motion from an object
         '''
         del self._motions[key]
+        self._baked_keys.pop(key, None)
+        self._motions_version += 1
+
+    def bake_motions(self, t0, t1, rate):
+        '''
+        Sample the motion of every model from time t0 to t1 at the given rate (samples per unit time)
+        into tables of positions, orientations and bases. Between t0 and t1, update_models then looks
+        up the latest sample instead of evaluating the motions, while motion outside of that range or
+        added after baking is still evaluated live. Changing a model's motion discards its samples.
+        Functions of time are called once per sample, or once with an array of all sample times if
+        the motion was added with vectorized=True (see add_motion).
+        '''
+        if rate <= 0 or t1 < t0:
+            raise ValueError('Motions must be baked at a positive rate over a non-empty time range')
+        times = t0 + np.arange(int(np.floor((t1 - t0)*rate)) + 1)/rate
+        keys = list(self._motions)
+        positions = np.full((len(keys), len(times), 3), np.nan)
+        orientations = np.full((len(keys), len(times), 3), np.nan)
+        for i, key in enumerate(keys):
+            position, orientation = self._motions[key].get_states(times)
+            if position is not None:
+                positions[i] = position
+            if orientation is not None:
+                orientations[i] = orientation
+        self._set_baked(t0, rate, keys, positions, orientations)
+
+    def save_baked_motions(self, file):
+        '''
+        Save the motion tables from bake_motions to a .npz file. Model keys are saved as strings.
+        '''
+        if self._baked is None:
+            raise ValueError('No motions have been baked')
+        t0, rate, positions, orientations, _ = self._baked
+        keys = sorted(self._baked_keys, key=self._baked_keys.get)
+        indices = [self._baked_keys[key] for key in keys]
+        np.savez(file, t0=t0, rate=rate, keys=np.array([str(key) for key in keys]),
+                 positions=positions[indices], orientations=orientations[indices])
+
+    def load_baked_motions(self, file):
+        '''
+        Load motion tables saved by save_baked_motions, replacing any baked motions
+        '''
+        with np.load(file) as data:
+            self._set_baked(float(data['t0']), float(data['rate']), data['keys'].tolist(),
+                            data['positions'], data['orientations'])
 
     def translate(self, key, translation):
         '''
@@ -82,8 +240,23 @@ class ModelManager:
         '''
         Orient a model with respect to the global basis
         '''
-        basis = oriented_basis(yaw, pitch, roll)
-        self._models[key].basis = basis
+        self._models[key].set_basis(oriented_bases(((yaw, pitch, roll),))[0], trusted=True)
+
+    def set_orientations(self, keys, orientations):
+        '''
+        Orient many models at once with respect to the global basis. orientations is an Nx3 iterable
+        of yaw-pitch-roll angles parallel to keys (see orient). The bases of all models are computed
+        in a single vectorized operation, and with a TransformStore, stored in a single update.
+        '''
+        keys = list(keys)
+        bases = oriented_bases(orientations)
+        if len(bases) != len(keys):
+            raise ValueError('There must be one orientation for each model')
+        if self._store is not None:
+            self._store.update(self._get_slots(keys), bases=np.swapaxes(bases, 1, 2), orthonormal=True)
+            return
+        for key, basis in zip(keys, bases):
+            self._models[key].set_basis(basis, trusted=True)
 
     def scale(self, key, factor):
         '''
@@ -136,9 +309,77 @@ class ModelManager:
         Get a list of a model's vertices
         '''
         if world:
-            return self._models[key].world_vertices
+            return [tuple(v) for v in self.get_vertex_array(key, world=True)[:3].T]
         return self._models[key].vertices
 
+    def get_vertex_array(self, key, world=False):
+        '''
+        Get a model's vertices as a 4xN matrix of homogeneous column vectors in model coordinates,
+        or in world coordinates if world is True. The world matrix is cached between calls, and is
+        only recomputed after the model or one of its parents moves. It should not be modified.
+        '''
+        model = self._models[key]
+        if not world:
+            return model.vertex_array
+        if key not in self._parents:
+            return model.world_vertex_array
+        self._update_world_transforms()
+        versions = (self._world[key][2], model.version)
+        cached = self._world_vertices.get(key)
+        if cached is None or cached[0] != versions:
+            cached = (versions, np.matmul(self.get_mesh_transform(key), model.mesh.vertex_array))
+            self._world_vertices[key] = cached
+        return cached[1]
+
+    def get_transform(self, key):
+        '''
+        Get the 4x4 matrix which converts a model's coordinates to world coordinates (including the
+        transforms of any parents)
+        '''
+        if key in self._parents:
+            self._update_world_transforms()
+            return self._world[key][0]
+        return self._models[key].transform
+
+    def get_transforms(self, keys):
+        '''
+        Get the matrices which convert the coordinates of many models to world coordinates,
+        as an Nx4x4 array parallel to keys
+        '''
+        keys = list(keys)
+        if self._store is not None:
+            transforms = self._store.transforms[self._get_slots(keys)]
+        else:
+            transforms = np.array([self._models[key].transform for key in keys]).reshape((-1, 4, 4))
+        if self._parents:
+            self._update_world_transforms()
+            for i, key in enumerate(keys):
+                if key in self._parents:
+                    transforms[i] = self._world[key][0]
+        return transforms
+
+    def get_mesh_transforms(self, keys):
+        '''
+        Get the matrices which convert the mesh coordinates of many models to world coordinates
+        (see get_mesh_transform), as an Nx4x4 array parallel to keys
+        '''
+        keys = list(keys)
+        local = np.array([self._models[key].local_transform for key in keys]).reshape((-1, 4, 4))
+        return np.matmul(self.get_transforms(keys), local)
+
+    def get_mesh(self, key):
+        '''
+        Get the Mesh holding a model's geometry
+        '''
+        return self._models[key].mesh
+
+    def get_mesh_transform(self, key):
+        '''
+        Get the 4x4 matrix which converts a model's mesh coordinates to world coordinates
+        (including the model's scale and local center and basis)
+        '''
+        return np.matmul(self.get_transform(key), self._models[key].local_transform)
+
     def get_colour(self, key):
         '''
         Get the current colour of a model
@@ -150,25 +391,165 @@ class ModelManager:
         Set the colour of a model. colour must be an RGB triplet.
         '''
         self._models[key].colour = colour
+        self._version += 1
 
     def get_faces(self, key):
         '''
-        Return a list of faces of a model. Note that faces are described by the
-        indices of their vertices, and so this list is meaningless without a
-        corresponding list of vertices (see get_vertices).
+        Return the faces of a model, as an FxK array if all faces have K vertices or as a list of
+        arrays otherwise. Note that faces are described by the indices of their vertices, and so
+        this is meaningless without a corresponding list of vertices (see get_vertices).
         '''
         return self._models[key].faces
 
+    def get_face_arrays(self, key):
+        '''
+        Return the faces of a model as a flat array of vertex indices, along with an array of
+        the offsets at which each face starts (the last offset being the number of indices)
+        '''
+        return self._models[key].face_arrays
+
+    def get_normals(self, key):
+        '''
+        Get the unit normals of a model's faces as a 3xF matrix in model coordinates.
+        Normals are parallel to the list of faces (see get_faces).
+        '''
+        return self._models[key].normals
+
+    def get_bounding_box(self, key):
+        '''
+        Get the axis-aligned bounding box of a model in model coordinates (lower and upper corners)
+        '''
+        return self._models[key].bounding_box
+
+    def get_bounding_sphere(self, key):
+        '''
+        Get the bounding sphere of a model in model coordinates (center and radius)
+        '''
+        return self._models[key].bounding_sphere
+
+    def raycast(self, origin, direction, min_distance=0.):
+        '''
+        Find the nearest model face hit by a ray from origin in the given direction (both 3-element
+        iterables in world coordinates), ignoring hits closer than min_distance. Returns the key of
+        the model, the index of the face (see get_faces) and the hit point, or None if nothing is hit.
+        Rays are converted to each model's mesh coordinates and tested against the mesh's bounding
+        volume hierarchy (see Mesh.bvh), so moving models never requires rebuilding it.
+        '''
+        origin = np.append(np.asarray(origin, dtype=np.float64).ravel(), 1)
+        direction = np.asarray(direction, dtype=np.float64).ravel()
+        length = np.linalg.norm(direction)
+        if origin.shape != (4,) or direction.shape != (3,) or not length:
+            raise ValueError('Rays must have a 3-element origin and a non-zero 3-element direction')
+        direction = np.append(direction/length, 0)
+
+        # Find where the ray enters each model's bounding sphere, in mesh coordinates
+        candidates = []
+        for key, model in self._models.items():
+            inverse = np.linalg.inv(self.get_mesh_transform(key))
+            mesh_origin, mesh_direction = np.matmul(inverse, origin)[:3], np.matmul(inverse, direction)[:3]
+            center, radius = model.mesh.bounding_sphere
+            offset = mesh_origin - center
+            a, b, c = np.dot(mesh_direction, mesh_direction), np.dot(offset, mesh_direction), np.dot(offset, offset)
+            discriminant = b*b - a*(c - radius*radius)
+            if discriminant < 0:
+                continue
+            enter, exit = (-b - np.sqrt(discriminant))/a, (-b + np.sqrt(discriminant))/a
+            if exit >= min_distance:
+                candidates.append((enter, key, model, mesh_origin, mesh_direction))
+
+        # Test the models' hierarchies in order of distance until no nearer hit is possible
+        nearest = None
+        for enter, key, model, mesh_origin, mesh_direction in sorted(candidates, key=lambda c: c[0]):
+            if nearest is not None and enter > nearest[0]:
+                break
+            t_max = np.inf if nearest is None else nearest[0]
+            hit = model.mesh.bvh.intersect(mesh_origin, mesh_direction, min_distance, t_max)
+            if hit is not None:
+                nearest = (hit[0], key, hit[1])
+        if nearest is None:
+            return None
+        t, key, face = nearest
+        return key, face, vector(origin[:3] + t*direction[:3])
+
     def update_models(self, time):
         '''
-        Update the position and orientation of all models based on their MotionMaps
+        Update the position and orientation of all models based on their MotionMaps, or on the
+        motion tables if motions have been baked (see bake_motions)
         '''
+        if self._store is not None:
+            self._update_stored_models(time)
+            return
         states = self._get_states(time)
         for key in states:
-            if states[key][0] is not None:
-                self.set_position(key, states[key][0])
-            if states[key][1] is not None:
-                self.orient(key, states[key][1][0], states[key][1][1], states[key][1][2])
+            state, basis = states[key]
+            if self._is_applied(key, state):
+                continue
+            if state[0] is not None:
+                self.set_position(key, state[0])
+            if basis is not None:
+                self._models[key].set_basis(basis, trusted=True)
+            elif state[1] is not None:
+                self.orient(key, state[1][0], state[1][1], state[1][2])
+            self._applied_states[key] = (state, self._models[key].version)
+
+    def get_snapshot(self, time, out=None):
+        '''
+        Evaluate the motions of all moving models at a time without changing the models. Returns a
+        snapshot of the keys of the models, an Nx3 array of their origins and an Nx3x3 array of their
+        bases (with the basis vectors as columns), where undefined positions and orientations are NaN.
+        Since the models are untouched, snapshots can be computed in another thread while the models
+        are drawn, and applied between frames with apply_snapshot, as long as models and motions aren't
+        changed meanwhile (see motions_version). The arrays of a previous snapshot (out) are reused if
+        they have the right size, so that two snapshots can be double-buffered.
+        '''
+        sample = self._baked_sample(time)
+        keys, motions, indices, _ = self._snapshot_plan(sample is not None)
+        n, n_live = len(keys), len(motions)
+        if out is not None and len(out[1]) == n:
+            origins, bases = out[1], out[2]
+        else:
+            origins, bases = np.empty((n, 3)), np.empty((n, 3, 3))
+        orientations = np.full((n_live, 3), np.nan)
+        origins[:n_live] = np.nan
+        for i, motion in enumerate(motions):
+            position, orientation = motion.get_state(time)
+            if position is not None:
+                origins[i] = np.ravel(position)
+            if orientation is not None:
+                orientations[i] = np.ravel(orientation)
+        bases[:n_live] = np.swapaxes(oriented_bases(orientations), 1, 2)
+        if len(indices):
+            _, _, positions, _, baked_bases = self._baked
+            origins[n_live:] = positions[indices, sample]
+            bases[n_live:] = np.swapaxes(baked_bases[indices, sample], 1, 2)
+        return keys, origins, bases
+
+    def apply_snapshot(self, snapshot):
+        '''
+        Move and orient models to the state in a snapshot from get_snapshot. Models which have been
+        removed since the snapshot was taken are skipped.
+        '''
+        keys, origins, bases = snapshot
+        moved = ~np.isnan(origins[:, 0])
+        rotated = ~np.isnan(bases[:, 0, 0])
+        if self._store is not None:
+            # Snapshots taken since models were last added or removed share their plan's slots
+            version, plans = self._snapshot_plans
+            slots = next((plan[3] for plan in plans.values() if plan[0] is keys), None)
+            if version != self._motions_version or slots is None:
+                slots = np.array([self._slots.get(key, -1) for key in keys], dtype=np.intp)
+            moved &= slots >= 0
+            rotated &= slots >= 0
+            self._store.update(slots[moved], origins=origins[moved])
+            self._store.update(slots[rotated], bases=bases[rotated])
+            return
+        for key, origin, basis, is_moved, is_rotated in zip(keys, origins, bases, moved, rotated):
+            if key not in self._models:
+                continue
+            if is_moved:
+                self._models[key].origin = origin
+            if is_rotated:
+                self._models[key].set_basis(basis.T, trusted=True)
 
     @property
     def models(self):
@@ -177,11 +558,186 @@ class ModelManager:
         '''
         return [model for model in self._models]
 
+    @property
+    def version(self):
+        '''
+        Value which changes whenever anything affecting the drawn models changes (models being added,
+        removed, moved, reoriented, scaled or recoloured, or their meshes changing)
+        '''
+        return self._version, tuple(model.version for model in self._models.values())
+
+    @property
+    def motions_version(self):
+        '''
+        Value which changes whenever models or motions are added or removed, motions are baked or
+        models are reparented, after which snapshots taken earlier (see get_snapshot) are out of date
+        '''
+        return self._motions_version
+
+    def _update_world_transforms(self):
+        '''
+        Update the cached world transforms of child models, parents first. A child's transform is only
+        recomputed if its own transform or its parent's world transform has changed since it was last
+        computed, so unchanged subtrees are skipped. Each computed transform is stamped with a number
+        which is never reused, so that the children of a reparented model see it change.
+        '''
+        if self._levels is None:
+            self._levels = self._hierarchy_levels()
+        for level in self._levels:
+            for key in level:
+                parent = self._parents[key]
+                is_child = parent in self._parents
+                if is_child:
+                    parent_transform, _, parent_version = self._world[parent]
+                else:
+                    parent_transform = self._models[parent].transform
+                    parent_version = self._models[parent].space.version
+                versions = (self._models[key].space.version, parent, is_child, parent_version)
+                world = self._world.get(key)
+                if world is not None and world[1] == versions:
+                    continue
+                self._world_stamp += 1
+                transform = np.matmul(parent_transform, self._models[key].transform)
+                self._world[key] = (transform, versions, self._world_stamp)
+
+    def _snapshot_plan(self, baked):
+        '''
+        Get the keys of the models in snapshots, the MotionMaps of the models evaluated live (which
+        come first), the indices in the motion tables of the other models and the slots of all of
+        them in the TransformStore (or None). baked selects plans for times in the baked range.
+        Plans are kept until models or motions change, so that snapshots don't look up each model.
+        '''
+        version, plans = self._snapshot_plans
+        if version != self._motions_version:
+            version, plans = self._motions_version, {}
+            self._snapshot_plans = (version, plans)
+        plan = plans.get(baked)
+        if plan is None:
+            live = [key for key in self._motions if not baked or key not in self._baked_keys]
+            tabled = [key for key in self._baked_keys if key in self._models] if baked else []
+            keys = tuple(live + tabled)
+            slots = None
+            if self._store is not None:
+                slots = np.array([self._slots.get(key, -1) for key in keys], dtype=np.intp)
+            plan = (keys, [self._motions[key] for key in live],
+                    np.array([self._baked_keys[key] for key in tabled], dtype=np.intp), slots)
+            plans[baked] = plan
+        return plan
+
+    def _get_slots(self, keys):
+        '''
+        Get the slots of models in the TransformStore as an array parallel to a list of keys. The
+        slots of the last list looked up are kept until models are added or removed, since the same
+        keys are usually looked up every frame.
+        '''
+        version, cached_keys, slots = self._slot_cache
+        if version != self._motions_version or cached_keys != keys:
+            slots = np.array([self._slots[key] for key in keys], dtype=np.intp)
+            self._slot_cache = (self._motions_version, list(keys), slots)
+        return slots
+
+    def _hierarchy_levels(self):
+        '''
+        Group the child models by their depth in the hierarchy (1 for children of top-level models)
+        '''
+        depths = {}
+        for key in self._parents:
+            chain = []
+            while key in self._parents and key not in depths:
+                chain.append(key)
+                key = self._parents[key]
+            depth = depths.get(key, 0)
+            for child in reversed(chain):
+                depth += 1
+                depths[child] = depth
+        levels = [[] for _ in range(max(depths.values(), default=0))]
+        for key, depth in depths.items():
+            levels[depth - 1].append(key)
+        return levels
+
+    def _create_mesh(self, **kwargs):
+        '''
+        Create a mesh from an STL file or vertices and faces, or return None if neither is given
+        '''
+        lod_levels = kwargs.get('lod_levels', 0)
+        stl_file = kwargs.get('stl_file', None)
+        if stl_file is not None:
+            return Mesh.from_stl(stl_file, cache=self._mesh_cache, lod_levels=lod_levels)
+        vertices = kwargs.get('vertices', None)
+        if vertices is None:
+            return None
+        mesh = Mesh(vertices=vertices, faces=kwargs.get('faces', None))
+        if lod_levels:
+            mesh.build_lods(lod_levels)
+        return mesh
+
+    def _is_applied(self, key, state):
+        '''
+        Check whether a state was the last one applied to a model, and the model has not moved since
+        '''
+        if key not in self._applied_states:
+            return False
+        applied, version = self._applied_states[key]
+        if version != self._models[key].version:
+            return False
+        for new_val, old_val in zip(state, applied):
+            if (new_val is None) != (old_val is None):
+                return False
+            if new_val is not None and not np.array_equal(new_val, old_val):
+                return False
+        return True
+
     def _get_states(self, time):
         '''
-        Get the current state of each model from its MotionMap
+        Get the current state of each model from its MotionMap or the motion tables, along with its
+        basis if it was precomputed
         '''
+        sample = self._baked_sample(time)
         states = {}
         for key in self._motions:
-            states[key] = self._motions[key].get_state(time)
+            if sample is None or key not in self._baked_keys:
+                states[key] = (self._motions[key].get_state(time), None)
+        if sample is not None:
+            for key, index in self._baked_keys.items():
+                if key in self._models:
+                    states[key] = self._baked_state(index, sample)
         return states
+
+    def _update_stored_models(self, time):
+        '''
+        Update the position and orientation of all models in the TransformStore at once. Only models
+        which actually move have their transforms recomputed.
+        '''
+        self.apply_snapshot(self.get_snapshot(time))
+
+    def _baked_sample(self, time):
+        '''
+        Index of the latest sample of the motion tables at the given time, or None if the time is
+        outside of the baked range
+        '''
+        if self._baked is None:
+            return None
+        t0, rate, positions, _, _ = self._baked
+        sample = int(np.floor((time - t0)*rate))
+        return sample if 0 <= sample < positions.shape[1] else None
+
+    def _baked_state(self, index, sample):
+        '''
+        Get a model's state and basis from the motion tables
+        '''
+        _, _, positions, orientations, bases = self._baked
+        position, orientation = positions[index, sample], orientations[index, sample]
+        if np.isnan(position[0]):
+            position = None
+        if np.isnan(orientation[0]):
+            return (position, None), None
+        return (position, orientation), bases[index, sample]
+
+    def _set_baked(self, t0, rate, keys, positions, orientations):
+        '''
+        Store motion tables, precomputing the basis of each orientation
+        '''
+        bases = oriented_bases(orientations).reshape(positions.shape + (3,))
+        self._baked = (t0, rate, np.ascontiguousarray(positions), np.ascontiguousarray(orientations), bases)
+        self._baked_keys = {key: i for i, key in enumerate(keys)}
+        self._motions_version += 1
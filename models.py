@@ -1,12 +1,29 @@
+import os
 import stl
 import numpy as np
 
-from linalg import vector, vector_matrix, basis_matrix, translation_matrix, XAXIS, YAXIS, ZAXIS
+from bvh import BVH
+from linalg import vector, vector_matrix, basis_matrix, translation_matrix, view_matrix, face_normals, \
+    euler_to_quaternion, quaternion_to_euler, slerp, XAXIS, YAXIS, ZAXIS
+
+# Version of the mesh processing done by Mesh._convert_stl. Changing this invalidates cached meshes.
+MESH_VERSION = 1
+
+# Layout of binary STL files
+STL_HEADER_SIZE = 84
+STL_RECORD = np.dtype([('normal', '<f4', (3,)), ('vectors', '<f4', (3, 3)), ('attr', '<u2')])
+
+# Ways of interpolating between keyframes (see Keyframes)
+INTERPOLATIONS = ('step', 'linear', 'slerp')
+
+# Number of refinements of the cell size used to reach the target vertex count of a level of detail
+LOD_SEARCH_STEPS = 4
 
 
 class Space:
     '''
-    Representation of a space in world coordinates
+    Representation of a space in world coordinates. A space may be stored in a TransformStore,
+    in which case its origin, basis and transform live in the store's arrays.
     '''
     def __init__(self, basis=(XAXIS, YAXIS, ZAXIS), origin=(0, 0, 0)):
         '''
@@ -14,8 +31,12 @@ class Space:
         origin: the position of the center of the space
         '''
         self._basis = None
+        self._orthonormal = False
         self._translation = None
         self._inverse = None
+        self._version = 0
+        self._store = None
+        self._slot = None
 
         if basis is not None:
             self.basis = basis
@@ -26,13 +47,33 @@ class Space:
         '''
         Convert a point in the Space's coordinates to world coordinates
         '''
-        return np.matmul(self._inverse, points)
+        return np.matmul(self.transform, points)
+
+    @property
+    def transform(self):
+        '''
+        4x4 matrix to convert points in the Space's coordinates to world coordinates
+        '''
+        if self._store is not None:
+            return self._store.transforms[self._slot].copy()
+        return self._inverse
+
+    @property
+    def version(self):
+        '''
+        Counter which is incremented whenever the origin or basis changes
+        '''
+        if self._store is not None:
+            return int(self._store.versions[self._slot])
+        return self._version
 
     @property
     def origin(self):
         '''
         Origin getter
         '''
+        if self._store is not None:
+            return self._store.origins[self._slot].copy()
         return self._translation[:3, 3]
 
     @origin.setter
@@ -40,7 +81,13 @@ class Space:
         '''
         Origin setter
         '''
-        self._translation = translation_matrix(origin[0], origin[1], origin[2])
+        translation = translation_matrix(origin[0], origin[1], origin[2])
+        if self._store is not None:
+            self._store.update([self._slot], origins=translation[:3, 3].reshape((1, 3)))
+            return
+        if self._translation is not None and np.array_equal(translation, self._translation):
+            return
+        self._translation = translation
         self._update_inverse()
 
     @property
@@ -48,6 +95,8 @@ class Space:
         '''
         Basis getter
         '''
+        if self._store is not None:
+            return self._store.bases[self._slot].copy()
         return self._basis[:3, :3]
 
     @basis.setter
@@ -55,38 +104,532 @@ class Space:
         '''
         Basis setter
         '''
-        self._basis = basis_matrix(basis)
+        self.set_basis(basis)
+
+    def set_basis(self, basis, trusted=False):
+        '''
+        Set the basis vectors of the space. If trusted is True, the vectors are assumed to form a
+        right-handed orthonormal basis (as from linalg.oriented_bases) and are not checked.
+        '''
+        basis = basis_matrix(basis, check=not trusted)
+        if self._store is not None:
+            self._store.update([self._slot], bases=basis[:3, :3].reshape((1, 3, 3)), orthonormal=trusted)
+            return
+        if self._basis is not None and np.array_equal(basis, self._basis):
+            return
+        self._basis = basis
+        self._orthonormal = trusted
         self._update_inverse()
 
+    def _bind(self, store, slot):
+        '''
+        Move the space's origin, basis and transform into a slot of a TransformStore, or back out
+        of its store if store is None
+        '''
+        if store is None and self._store is not None:
+            self._translation = translation_matrix(*self._store.origins[self._slot])
+            self._basis = basis_matrix(self._store.bases[self._slot].T, check=False)
+            self._orthonormal = bool(self._store.orthonormal[self._slot])
+            self._inverse = self._store.transforms[self._slot].copy()
+            self._version = int(self._store.versions[self._slot])
+        self._store, self._slot = store, slot
+
     def _update_inverse(self):
         '''
-        Update the inverse transformation matrix
+        Update the inverse transformation matrix. Trusted bases are orthonormal, so they are inverted
+        by transposing them.
         '''
+        self._version += 1
         if self._basis is not None and self._translation is not None:
-            self._inverse = np.matmul(self._translation, np.linalg.inv(self._basis))
+            inverse = self._basis.T if self._orthonormal else np.linalg.inv(self._basis)
+            self._inverse = np.matmul(self._translation, inverse)
 
 
-class Model:
+class TransformStore:
     '''
-    Simple wireframe representation of an object
+    Contiguous storage of the origins, bases and transforms of many spaces, which allows them to be
+    read and updated together. Each space stored occupies a slot (an index into the arrays).
     '''
-    def __init__(self, vertices=None, faces=None, colour=(255, 0, 0)):
+    def __init__(self, capacity=64):
         '''
-        vertices:   a list of the model's vertices
-        faces:      a list of the model's faces, described by the indices of their vertices
-        colour:     an RGB triplet describing the model's colour
+        capacity:   number of slots to allocate initially (more are allocated as needed)
+        '''
+        self._origins = np.zeros((capacity, 3))
+        self._bases = np.zeros((capacity, 3, 3))
+        self._transforms = np.zeros((capacity, 4, 4))
+        self._orthonormal = np.zeros(capacity, dtype=bool)
+        self._versions = np.zeros(capacity, dtype=np.int64)
+        self._spaces = []  # space in each slot, or None for free slots
+        self._free = []
+
+    @property
+    def origins(self):
+        '''
+        Nx3 array of the origins of the spaces in each slot. It should not be modified.
+        '''
+        return self._origins[:len(self._spaces)]
+
+    @property
+    def bases(self):
+        '''
+        Nx3x3 array of the bases of the spaces in each slot, with the basis vectors as columns.
+        It should not be modified.
+        '''
+        return self._bases[:len(self._spaces)]
+
+    @property
+    def transforms(self):
+        '''
+        Nx4x4 array of the matrices converting each slot's space coordinates to world coordinates.
+        It should not be modified.
+        '''
+        return self._transforms[:len(self._spaces)]
+
+    @property
+    def orthonormal(self):
+        '''
+        Array indicating which slots have bases trusted to be orthonormal (see Space.set_basis)
+        '''
+        return self._orthonormal[:len(self._spaces)]
+
+    @property
+    def versions(self):
+        '''
+        Array of counters which are incremented whenever the origin or basis in each slot changes
+        '''
+        return self._versions[:len(self._spaces)]
+
+    def add(self, space):
+        '''
+        Move a space into a free slot, returning the slot
+        '''
+        if space._store is not None:
+            raise ValueError('Space is already stored')
+        if self._free:
+            slot = self._free.pop()
+            self._spaces[slot] = space
+        else:
+            slot = len(self._spaces)
+            if slot == len(self._origins):
+                self._grow()
+            self._spaces.append(space)
+        self._origins[slot] = space.origin
+        self._bases[slot] = space.basis
+        self._transforms[slot] = space.transform
+        self._orthonormal[slot] = space._orthonormal
+        self._versions[slot] = space.version
+        space._bind(self, slot)
+        return slot
+
+    def remove(self, space):
+        '''
+        Move a space out of the store, freeing its slot
+        '''
+        if space._store is not self:
+            raise ValueError('Space is not in this store')
+        slot = space._slot
+        space._bind(None, None)
+        self._spaces[slot] = None
+        self._free.append(slot)
+
+    def update(self, slots, origins=None, bases=None, orthonormal=True):
+        '''
+        Set the origins (Nx3) and/or bases (Nx3x3, with basis vectors as columns) of many slots at
+        once, and recompute their transforms. Only the slots whose origin or basis changes have their
+        transforms recomputed and versions incremented. Bases are assumed to be orthonormal unless
+        orthonormal is False.
+        '''
+        slots = np.asarray(slots, dtype=np.intp)
+        changed = np.zeros(len(slots), dtype=bool)
+        if origins is not None:
+            origins = np.asarray(origins, dtype=np.float64)
+            changed |= np.any(self._origins[slots] != origins, axis=1)
+            self._origins[slots] = origins
+        if bases is not None:
+            bases = np.asarray(bases, dtype=np.float64)
+            changed |= np.any(self._bases[slots] != bases, axis=(1, 2)) | (self._orthonormal[slots] != orthonormal)
+            self._bases[slots] = bases
+            self._orthonormal[slots] = orthonormal
+        slots = slots[changed]
+        if not len(slots):
+            return
+
+        # Orthonormal bases are inverted by transposing them
+        inverses = np.swapaxes(self._bases[slots], 1, 2)
+        irregular = ~self._orthonormal[slots]
+        if np.any(irregular):
+            inverses[irregular] = np.linalg.inv(self._bases[slots[irregular]])
+        self._transforms[slots, :3, :3] = inverses
+        self._transforms[slots, :3, 3] = self._origins[slots]
+        self._transforms[slots, 3] = (0, 0, 0, 1)
+        self._versions[slots] += 1
+
+    def _grow(self):
+        '''
+        Double the number of slots
+        '''
+        capacity = max(2*len(self._origins), 1)
+        for name in ('_origins', '_bases', '_transforms', '_orthonormal', '_versions'):
+            array = getattr(self, name)
+            grown = np.zeros((capacity,) + array.shape[1:], dtype=array.dtype)
+            grown[:len(array)] = array
+            setattr(self, name, grown)
+
+
+class Mesh:
+    '''
+    Geometry (vertices and faces) which may be shared by many models
+    '''
+    def __init__(self, vertices=None, faces=None):
+        '''
+        vertices:   a list or Nx3 array of the mesh's vertices
+        faces:      a list or FxK array of the mesh's faces, described by the indices of their vertices
         '''
         self._vertices = np.zeros((4, 0))
-        self._faces = []
-        self._colour = colour
-        self._space = Space()  # initial Space is the same as the world frame
+        self._face_indices = np.zeros(0, dtype=np.int32)
+        self._face_offsets = np.zeros(1, dtype=np.int32)
+        self._normals = np.zeros((3, 0))
+        self._bounding_box = (np.zeros(3), np.zeros(3))
+        self._bounding_sphere = (np.zeros(3), 0.)
+        self._lods = []
+        self._bvh = None
+        self._version = 0
 
         if vertices is not None:
             self.vertices = vertices
             if faces is not None:
                 self.faces = faces
 
-        self.set_local_center(self.centroid)
+    @property
+    def version(self):
+        '''
+        Counter which is incremented whenever the vertices or faces change
+        '''
+        return self._version
+
+    @property
+    def vertex_array(self):
+        '''
+        4xN matrix of the mesh's vertices as homogeneous column vectors. It should not be modified.
+        '''
+        return self._vertices
+
+    @property
+    def vertices(self):
+        '''
+        List of vertices of the mesh
+        '''
+        return [tuple(self._vertices[:3, i]) for i in range(self._vertices.shape[1])]
+
+    @vertices.setter
+    def vertices(self, vertices):
+        '''
+        Set the mesh vertices
+        '''
+        self._vertices = vector_matrix(vertices, w=1)
+        self._update_geometry()
+
+    @property
+    def faces(self):
+        '''
+        Faces of the mesh, specified by their vertex indices. If every face has the same number of
+        vertices K, this is an FxK array (which should not be modified). Otherwise, it is a list of arrays.
+        '''
+        counts = np.diff(self._face_offsets)
+        if not len(counts) or np.all(counts == counts[0]):
+            return self._face_indices.reshape((len(counts), counts[0] if len(counts) else 3))
+        return np.split(self._face_indices, self._face_offsets[1:-1])
+
+    @faces.setter
+    def faces(self, faces):
+        '''
+        Set the faces of the mesh. Note that this erases any existing faces.
+        To add new faces, use add_faces instead.
+        '''
+        self._face_indices = np.zeros(0, dtype=np.int32)
+        self._face_offsets = np.zeros(1, dtype=np.int32)
+        self.add_faces(faces)
+
+    @property
+    def face_arrays(self):
+        '''
+        Faces of the mesh as a flat array of vertex indices and an array of the offsets at which each
+        face starts (with the total number of indices appended). These arrays should not be modified.
+        '''
+        return self._face_indices, self._face_offsets
+
+    def add_faces(self, faces):
+        '''
+        Add new faces to the mesh. faces may be an FxK array or an iterable of faces.
+        '''
+        indices, offsets = self._to_face_arrays(faces)
+        if len(indices) and (np.min(indices) < 0 or np.max(indices) >= self._vertices.shape[1]):
+            raise IndexError('Face contains vertices which do not exist')
+        self._face_indices = np.concatenate((self._face_indices, indices))
+        self._face_offsets = np.concatenate((self._face_offsets[:-1], offsets + self._face_offsets[-1]))
+        self._update_geometry()
+
+    @property
+    def normals(self):
+        '''
+        3xF matrix of the unit normals of the mesh's faces
+        '''
+        return self._normals
+
+    @property
+    def bounding_box(self):
+        '''
+        Axis-aligned bounding box of the mesh, as a pair of lower and upper corners
+        '''
+        return self._bounding_box
+
+    @property
+    def bounding_sphere(self):
+        '''
+        Bounding sphere of the mesh, as a pair of center and radius
+        '''
+        return self._bounding_sphere
+
+    @property
+    def centroid(self):
+        '''
+        Centroid of the mesh's vertices
+        '''
+        return np.sum(self._vertices[:3], axis=1)/self._vertices.shape[1]
+
+    @property
+    def bvh(self):
+        '''
+        Bounding volume hierarchy of the mesh's faces (see BVH), which is built when first needed
+        '''
+        if self._bvh is None:
+            self._bvh = BVH(self._vertices, self._face_indices, self._face_offsets)
+        return self._bvh
+
+    @property
+    def lods(self):
+        '''
+        Levels of detail of the mesh, starting with the mesh itself and followed by
+        progressively simplified meshes (see build_lods)
+        '''
+        return [self] + self._lods
+
+    def build_lods(self, levels, reduction=4):
+        '''
+        Build a chain of simplified meshes by vertex clustering, each having about 1/reduction
+        times as many vertices as the previous level. Fewer levels are built if the mesh cannot
+        be simplified further. Any existing levels of detail are replaced.
+        '''
+        if reduction <= 1:
+            raise ValueError('LOD reduction must be greater than 1')
+        self._lods = []
+        mesh = self
+        for _ in range(levels):
+            target = mesh.vertex_array.shape[1]/reduction
+            if target < 4:
+                break
+            mesh = self.simplify(self._lod_cell_size(target))
+            if not len(mesh.normals[0]) or mesh.vertex_array.shape[1] >= self.lods[-1].vertex_array.shape[1]:
+                break
+            self._lods.append(mesh)
+
+    def simplify(self, cell_size):
+        '''
+        Create a simplified copy of the mesh by vertex clustering. Vertices are grouped into cubic
+        cells of the given size and merged into their mean, and faces which collapse are removed.
+        '''
+        if cell_size <= 0:
+            raise ValueError('Cell size must be positive')
+        clusters, n_clusters = self._clusters(cell_size)
+        sizes = np.bincount(clusters, minlength=n_clusters)
+        vertices = np.stack([np.bincount(clusters, weights=self._vertices[i], minlength=n_clusters)/sizes
+                             for i in range(3)], axis=1)
+
+        # Drop repeated consecutive vertices (including the last and first) from each face
+        indices, offsets = clusters[self._face_indices], self._face_offsets
+        previous = np.arange(len(indices)) - 1
+        previous[offsets[:-1]] = offsets[1:] - 1
+        distinct = indices != indices[previous]
+        counts = np.diff(offsets)
+        if len(counts):
+            counts = np.add.reduceat(distinct, offsets[:-1])
+        kept = counts >= 3
+        indices = indices[distinct & np.repeat(kept, np.diff(offsets))]
+        counts = counts[kept]
+        indices, counts = self._merge_faces(indices, counts)
+
+        # Remove vertices which are no longer used
+        used = np.unique(indices)
+        remap = np.zeros(n_clusters, dtype=np.int32)
+        remap[used] = np.arange(len(used))
+        mesh = Mesh(vertices=vertices[used])
+        mesh._face_indices = remap[indices]
+        mesh._face_offsets = np.concatenate(([0], np.cumsum(counts))).astype(np.int32)
+        mesh._update_geometry()
+        return mesh
+
+    @classmethod
+    def from_stl(cls, stl_file, cache=None, lod_levels=0):
+        '''
+        Create a mesh from an STL file. If a MeshCache is given, the processed mesh
+        is loaded from the cache when possible, and stored in it otherwise.
+        If lod_levels is given, that many levels of detail are built (see build_lods).
+        '''
+        if cache is None:
+            vertices, faces = cls._convert_stl(stl_file)
+        else:
+            key = cache.key(stl_file)
+            mesh = cache.load(key)
+            if mesh is None:
+                mesh = cls._convert_stl(stl_file)
+                cache.store(key, *mesh)
+            vertices, faces = mesh
+        mesh = cls(vertices=vertices, faces=faces)
+        if lod_levels:
+            mesh.build_lods(lod_levels)
+        return mesh
+
+    @staticmethod
+    def _to_face_arrays(faces):
+        '''
+        Convert faces to a flat array of vertex indices and an array of face offsets
+        '''
+        if not isinstance(faces, np.ndarray):
+            faces = list(faces)
+            counts = np.array([len(face) for face in faces], dtype=np.int32)
+            if len(counts) and np.any(counts != counts[0]):
+                indices = np.array([i for face in faces for i in face], dtype=np.int32)
+                offsets = np.concatenate(([0], np.cumsum(counts))).astype(np.int32)
+                faces = None
+            else:
+                faces = np.array(faces).reshape((len(counts), counts[0] if len(counts) else 3))
+        if faces is not None:
+            if faces.ndim != 2:
+                raise TypeError('Face arrays must be two-dimensional')
+            indices = faces.astype(np.int32).ravel()
+            offsets = (np.arange(faces.shape[0] + 1)*faces.shape[1]).astype(np.int32)
+        if np.any(np.diff(offsets) < 3):
+            raise ValueError('Faces must have at least 3 vertices')
+        return indices, offsets
+
+    def _clusters(self, cell_size):
+        '''
+        Group the vertices into cubic cells of the given size. Returns the cluster of each vertex
+        and the number of clusters.
+        '''
+        cells = np.floor((self._vertices[:3].T - self._bounding_box[0])/cell_size).astype(np.int64)
+        _, clusters = self._weld(cells)
+        return clusters, (np.max(clusters) + 1 if len(clusters) else 0)
+
+    @staticmethod
+    def _merge_faces(indices, counts):
+        '''
+        Remove faces (given as flat vertex indices and vertex counts) which have the same vertices
+        as an earlier face
+        '''
+        offsets = np.cumsum(counts) - counts
+        kept = np.zeros(len(counts), dtype=bool)
+        for count in np.unique(counts):
+            face_ids = np.flatnonzero(counts == count)
+            faces = np.sort(indices[offsets[face_ids].reshape((-1, 1)) + np.arange(count)], axis=1)
+            _, first = np.unique(faces, axis=0, return_index=True)
+            kept[face_ids[first]] = True
+        return indices[np.repeat(kept, counts)], counts[kept]
+
+    def _lod_cell_size(self, target):
+        '''
+        Find a clustering cell size which reduces the mesh to about the target number of vertices.
+        The vertices of a surface occupy a number of cells inversely proportional to the square of
+        the cell size, so the size is refined from an initial guess based on the mesh's extent.
+        '''
+        lower, upper = self._bounding_box
+        cell_size = np.max(upper - lower)/np.sqrt(target)
+        for _ in range(LOD_SEARCH_STEPS):
+            _, n_clusters = self._clusters(cell_size)
+            cell_size *= np.sqrt(n_clusters/target)
+        return cell_size
+
+    def _update_geometry(self):
+        '''
+        Recompute the face normals and bounding volumes after the vertices or faces have changed.
+        Any levels of detail and bounding volume hierarchy are discarded.
+        '''
+        self._version += 1
+        self._lods = []
+        self._bvh = None
+        self._normals = face_normals(self._vertices, self._face_indices, self._face_offsets)
+        if self._vertices.shape[1]:
+            lower, upper = np.min(self._vertices[:3], axis=1), np.max(self._vertices[:3], axis=1)
+            center = (lower + upper)/2
+            radius = np.max(np.linalg.norm(self._vertices[:3] - center.reshape(3, 1), axis=0))
+            self._bounding_box = (lower, upper)
+            self._bounding_sphere = (center, radius)
+
+    @staticmethod
+    def _convert_stl(file):
+        '''
+        Convert an STL to an Nx3 array of vertices and an Fx3 array of faces.
+        Identical vertices are welded together.
+        '''
+        vertices, inv = Mesh._weld(Mesh._read_stl(file).reshape((-1, 3)))
+        return vertices, inv.reshape((-1, 3)).astype(np.int32)
+
+    @staticmethod
+    def _weld(points):
+        '''
+        Find the unique rows of an Nx3 array of points, in lexicographic order, and the index of
+        each point's row in the unique array (equivalent to np.unique along axis 0, but faster)
+        '''
+        order = np.lexsort(points.T[::-1])
+        points = points[order]
+        first = np.ones(len(points), dtype=bool)
+        first[1:] = np.any(points[1:] != points[:-1], axis=1)
+        inv = np.empty(len(points), dtype=np.intp)
+        inv[order] = np.cumsum(first) - 1
+        return points[first], inv
+
+    @staticmethod
+    def _read_stl(file):
+        '''
+        Read the triangles of an STL file as an Fx3x3 array. Binary files are memory mapped,
+        while ASCII files are parsed by numpy-stl.
+        '''
+        size = os.path.getsize(file)
+        if size >= STL_HEADER_SIZE:
+            count = int(np.fromfile(file, dtype='<u4', count=1, offset=STL_HEADER_SIZE - 4)[0])
+            if size == STL_HEADER_SIZE + count*STL_RECORD.itemsize:
+                if not count:
+                    return np.zeros((0, 3, 3), dtype=np.float32)
+                return np.memmap(file, dtype=STL_RECORD, mode='r', offset=STL_HEADER_SIZE, shape=(count,))['vectors']
+        return stl.mesh.Mesh.from_file(file).vectors
+
+
+class Model:
+    '''
+    Simple wireframe representation of an object. The object's geometry is held by a Mesh,
+    which may be shared with other models, while each model has its own position, orientation,
+    scale and colour.
+    '''
+    def __init__(self, vertices=None, faces=None, colour=(255, 0, 0), mesh=None):
+        '''
+        vertices:   a list of the model's vertices
+        faces:      a list of the model's faces, described by the indices of their vertices
+        colour:     an RGB triplet describing the model's colour
+        mesh:       a Mesh shared with other models, used instead of vertices and faces
+        '''
+        if mesh is None:
+            mesh = Mesh(vertices=vertices, faces=faces)
+        elif not isinstance(mesh, Mesh):
+            raise TypeError(f'Mesh of type {type(mesh).__name__} cannot be used')
+        self._mesh = mesh
+        self._local = np.identity(4)  # converts mesh coordinates to model coordinates
+        self._local_version = 0
+        self._world_vertices = (None, None)  # version of the cached world vertices and the vertices
+        self._colour = colour
+        self._space = Space()  # initial Space is the same as the world frame
+
+        if mesh.vertex_array.shape[1]:
+            self.set_local_center(self.centroid)
 
     @property
     def origin(self):
@@ -116,42 +659,141 @@ class Model:
         '''
         self._space.basis = basis
 
+    def set_basis(self, basis, trusted=False):
+        '''
+        Set the basis vectors of the model in world coordinates, optionally skipping the check that
+        they form a right-handed orthonormal basis (see Space.set_basis)
+        '''
+        self._space.set_basis(basis, trusted)
+
+    @property
+    def mesh(self):
+        '''
+        Mesh holding the model's geometry
+        '''
+        return self._mesh
+
+    @property
+    def transform(self):
+        '''
+        4x4 matrix to convert model coordinates to world coordinates
+        '''
+        return self._space.transform
+
+    @property
+    def space(self):
+        '''
+        Space holding the model's position and orientation in world coordinates
+        '''
+        return self._space
+
+    @property
+    def local_transform(self):
+        '''
+        4x4 matrix to convert the model's mesh coordinates to model coordinates (its scale and
+        local center and basis). It should not be modified.
+        '''
+        return self._local
+
+    @property
+    def mesh_transform(self):
+        '''
+        4x4 matrix to convert mesh coordinates to world coordinates. This includes the
+        model's scale and local center and basis.
+        '''
+        return np.matmul(self._space.transform, self._local)
+
+    @property
+    def version(self):
+        '''
+        Counters which change whenever the model's Space, local transform or mesh change
+        '''
+        return self._space.version, self._local_version, self._mesh.version
+
+    @property
+    def vertex_array(self):
+        '''
+        4xN matrix of the model's vertices as homogeneous column vectors
+        '''
+        return np.matmul(self._local, self._mesh.vertex_array)
+
     @property
     def vertices(self):
         '''
         List of vertices of the model
         '''
-        return [tuple(self._vertices[:3, i]) for i in range(self._vertices.shape[1])]
+        vertices = self.vertex_array
+        return [tuple(vertices[:3, i]) for i in range(vertices.shape[1])]
 
     @vertices.setter
     def vertices(self, vertices):
         '''
-        Set the model vertices
+        Set the model vertices. The model is given its own mesh with the new vertices and its current faces.
         '''
-        self._vertices = vector_matrix(vertices, w=1)
+        faces = self._mesh.faces
+        self._mesh = Mesh(vertices=vertices, faces=faces if len(faces) else None)
+        self._local = np.identity(4)
+        self._local_version += 1
 
     @property
     def faces(self):
         '''
-        List of faces of the model, specified by their vertex indices
+        Faces of the model, specified by their vertex indices (see Mesh.faces)
         '''
-        return self._faces
+        return self._mesh.faces
 
     @faces.setter
     def faces(self, faces):
         '''
         Set the faces of the model. Note that this erases any existing faces.
-        To add new faces, use add_faces instead.
+        To add new faces, use add_faces instead. The model is given its own mesh.
         '''
-        self._faces = []
-        self.add_faces(faces)
+        self._mesh = Mesh(vertices=self._mesh.vertex_array[:3].T, faces=faces)
+
+    @property
+    def face_arrays(self):
+        '''
+        Faces of the model as a flat array of vertex indices and an array of face offsets (see Mesh.face_arrays)
+        '''
+        return self._mesh.face_arrays
 
     def add_faces(self, faces):
         '''
-        Add new faces to the model
+        Add new faces to the model. The model is given its own mesh.
+        '''
+        mesh = Mesh(vertices=self._mesh.vertex_array[:3].T)
+        mesh.add_faces(self._mesh.faces)
+        mesh.add_faces(faces)
+        self._mesh = mesh
+
+    @property
+    def normals(self):
+        '''
+        3xF matrix of the unit normals of the model's faces in model coordinates
+        '''
+        normals = np.matmul(np.linalg.inv(self._local[:3, :3]).T, self._mesh.normals)
+        norms = np.linalg.norm(normals, axis=0)
+        return normals/np.where(norms > 0, norms, 1)
+
+    @property
+    def bounding_box(self):
+        '''
+        Axis-aligned bounding box of the model in model coordinates, as a pair of lower and upper corners
+        '''
+        lower, upper = self._mesh.bounding_box
+        corners = np.array([[x, y, z, 1] for x in (lower[0], upper[0])
+                            for y in (lower[1], upper[1]) for z in (lower[2], upper[2])]).T
+        corners = np.matmul(self._local, corners)[:3]
+        return np.min(corners, axis=1), np.max(corners, axis=1)
+
+    @property
+    def bounding_sphere(self):
+        '''
+        Bounding sphere of the model in model coordinates, as a pair of center and radius
         '''
-        for f in faces:
-            self._add_face(f)
+        center, radius = self._mesh.bounding_sphere
+        center = np.matmul(self._local, np.append(center, 1))[:3]
+        return center, radius*np.linalg.norm(self._local[:3, :3], 2)
 
     @property
     def colour(self):
@@ -174,23 +816,34 @@ class Model:
         '''
         Centroid of the model in world coordinates
         '''
-        return np.sum(self._vertices[:3], axis=1)/self._vertices.shape[1]
+        return np.matmul(self._local, np.append(self._mesh.centroid, 1))[:3]
 
     @property
     def world_vertices(self):
         '''
         List of model vertices in world coordinates
         '''
-        world_vertices = self._space.invert(self._vertices)
-        return [tuple(world_vertices[:3, i]) for i in range(self._vertices.shape[1])]
+        world_vertices = self.world_vertex_array
+        return [tuple(world_vertices[:3, i]) for i in range(world_vertices.shape[1])]
+
+    @property
+    def world_vertex_array(self):
+        '''
+        4xN matrix of the model's vertices in world coordinates. The matrix is cached, and is only
+        recomputed after the origin, basis, or local vertices change. It should not be modified.
+        '''
+        version, world_vertices = self._world_vertices
+        if version != self.version:
+            world_vertices = np.matmul(self.mesh_transform, self._mesh.vertex_array)
+            self._world_vertices = (self.version, world_vertices)
+        return world_vertices
 
     def set_local_center(self, center):
         '''
         Set the local center of the model. This is the point at which
         the origin is assumed to be.
         '''
-        tmat = translation_matrix(-center[0], -center[1], -center[2])
-        self._vertices = np.matmul(tmat, self._vertices)
+        self._update_local(translation_matrix(-center[0], -center[1], -center[2]))
 
     def change_local_basis(self, basis):
         '''
@@ -199,72 +852,128 @@ class Model:
         '''
         current_basis = [tuple(self._space.basis[:, i]) for i in range(3)]
         self._space.basis = basis
-        self._vertices = self._space.invert(self._vertices)
+        tmat = self._space.transform
         self._space.basis = current_basis
+        self._update_local(tmat)
 
     def scale(self, factor):
         '''
         Scale the model about its origin
         '''
-        self._vertices[:3, :] = self._vertices[:3, :]*factor
+        self._update_local(np.diag((factor, factor, factor, 1.)))
 
     @classmethod
-    def from_stl(cls, stl_file):
+    def from_stl(cls, stl_file, cache=None, lod_levels=0):
         '''
-        Create a model from an STL file
+        Create a model from an STL file (see Mesh.from_stl)
         '''
-        vertices, faces = cls._convert_stl(stl_file)
-        return cls(vertices=vertices, faces=faces)
+        return cls(mesh=Mesh.from_stl(stl_file, cache=cache, lod_levels=lod_levels))
 
-    def _add_face(self, face):
+    def _update_local(self, tmat):
         '''
-        Add a face to the model
+        Apply a transformation to the model coordinates. The mesh itself is unchanged.
         '''
-        if any((i < 0 or i >= self._vertices.shape[1] for i in face)):
-            raise IndexError('Face contains vertices which do not exist')
-        self._faces.append(tuple(i for i in face))
+        self._local = np.matmul(tmat, self._local)
+        self._local_version += 1
 
-    @staticmethod
-    def _convert_stl(file):
+
+class Keyframes:
+    '''
+    Values at a sequence of times, defining a function of time. Values are defined from the first
+    time up to (but not including) the last time, and are None outside of that range.
+    '''
+    def __init__(self, times, values, interpolation='step'):
+        '''
+        times:          increasing iterable of times
+        values:         iterable of 3-element values parallel to times (extra times are ignored)
+        interpolation:  'step' to hold each value until the next time, 'linear' to interpolate linearly
+                        between values, or 'slerp' to interpolate yaw-pitch-roll angles along the
+                        shortest rotation between them
+        '''
+        if interpolation not in INTERPOLATIONS:
+            raise ValueError(f'Unknown interpolation {interpolation}')
+        self._values = values if isinstance(values, np.ndarray) else list(values)
+        self._array = np.array(self._values, dtype=np.float64).reshape((len(self._values), -1)) \
+            if len(self._values) else np.zeros((0, 3))
+        self._times = np.array(times, dtype=np.float64).ravel()[:len(self._values)]
+        if np.any(np.diff(self._times) < 0):
+            raise ValueError('Keyframe times must be increasing')
+        self._interpolation = interpolation
+        if interpolation == 'slerp':
+            self._quaternions = euler_to_quaternion(self._array)
+
+    def __call__(self, time):
         '''
-        Convert an STL to a set of vertices and faces
+        Get the value at the given time
         '''
-        mesh = stl.mesh.Mesh.from_file(file)
-        vertices, inv = np.unique(np.vstack(mesh.vectors), axis=0, return_inverse=True)
-        vertices = [tuple(vertex) for vertex in vertices]
-        vert_idx = np.array(range(len(vertices)))
+        idx = int(np.searchsorted(self._times, time, side='right'))
+        if not idx or idx == len(self._times):
+            return None
+        if self._interpolation == 'step':
+            return self._values[idx - 1]
+        return self._interpolate(np.array([idx]), np.array([time], dtype=np.float64))[0]
+
+    def evaluate(self, times):
+        '''
+        Get the values at an array of times as a Tx3 array, with rows of NaN where values are undefined.
+        Returns None if there are no values.
+        '''
+        if not len(self._values):
+            return None
+        times = np.asarray(times, dtype=np.float64).ravel()
+        idx = np.searchsorted(self._times, times, side='right')
+        defined = (idx > 0) & (idx < len(self._times))
+        values = np.full((len(times), self._array.shape[1]), np.nan)
+        if self._interpolation == 'step':
+            values[defined] = self._array[idx[defined] - 1]
+        else:
+            values[defined] = self._interpolate(idx[defined], times[defined])
+        return values
 
-        faces = []
-        for i in range(mesh.vectors.shape[0]):
-            faces.append(tuple(vert_idx[inv[[3*i, 3*i + 1, 3*i + 2]]]))
-        return vertices, faces
+    def _interpolate(self, idx, times):
+        '''
+        Interpolate between the values before and at the given indices, for times between them
+        '''
+        fraction = (times - self._times[idx - 1])/(self._times[idx] - self._times[idx - 1])
+        if self._interpolation == 'slerp':
+            return quaternion_to_euler(slerp(self._quaternions[idx - 1], self._quaternions[idx], fraction))
+        before, after = self._array[idx - 1], self._array[idx]
+        return before + fraction.reshape((-1, 1))*(after - before)
 
 
 class MotionMap:
     '''
     Defines motion over time
     '''
-    def __init__(self, positions=(), orientations=(), times=()):
+    def __init__(self, positions=(), orientations=(), times=(), interpolation='step',
+                 vectorized=False):
         '''
         positions:      iterable or callable defining position over time
         orientations:   iterable or callable defining position over time
         times:          iterable of times
+        interpolation:  how positions and orientations given as iterables are interpolated between
+                        times (see Keyframes). With 'slerp', positions are interpolated linearly.
+        vectorized:     if True, callables also accept an array of times, returning 3 values which
+                        are each an array parallel to the times or a scalar (see get_states)
 
         Note: if using non-empty iterables, the iterables must have the same length
         and are assumed to be parallel (i.e. at time times[0], position is positions[0])
         '''
+        if interpolation not in INTERPOLATIONS:
+            raise ValueError(f'Unknown interpolation {interpolation}')
         self._position = None
         self._orientation = None
+        self._vectorized = vectorized
 
         if callable(positions):
             self._position = positions
         else:
-            self._position = self._piecewise(times, positions)
+            self._position = Keyframes(times, positions, 'linear' if interpolation == 'slerp' else interpolation)
 
         if callable(orientations):
             self._orientation = orientations
         else:
-            self._orientation = self._piecewise(times, orientations)
+            self._orientation = Keyframes(times, orientations, interpolation)
 
     def get_state(self, time):
         '''
@@ -272,26 +981,40 @@ class MotionMap:
         '''
         return self._position(time), self._orientation(time)
 
-    @staticmethod
-    def _piecewise(times, vals):
+    def get_states(self, times):
         '''
-        Turns a list of times and vals into a continuous function, v(t)
+        Get the states of motion at an array of times, as a pair of Tx3 arrays of positions and
+        orientations. Rows are NaN at times where the state is undefined, and either array is None
+        if the motion does not define it at all. Callables are called once per time, unless the
+        motion is vectorized, in which case they are called once with the whole array.
         '''
-        times = np.array(times[:len(vals)]).ravel()
-        vals = list(vals)
-        last_idx = [0]  # list so that it is mutable
+        return self._evaluate(self._position, times), self._evaluate(self._orientation, times)
 
-        def v(t):
-            out = None
-            indices = np.where(times[last_idx[0]:] > t)[0]
-            if len(indices):
-                idx = indices[0] + last_idx[0]
-                if idx:
-                    idx -= 1
-                    out = vals[idx]
-                    last_idx[0] = idx
-            return out
-        return v
+    def _evaluate(self, function, times):
+        '''
+        Evaluate a position or orientation function at an array of times
+        '''
+        times = np.asarray(times, dtype=np.float64).ravel()
+        if isinstance(function, Keyframes):
+            return function.evaluate(times)
+        if self._vectorized and len(times):
+            return self._evaluate_vectorized(function, times)
+        values = [function(t) for t in times]
+        return np.array([np.full(3, np.nan) if value is None else np.ravel(value) for value in values],
+                        dtype=np.float64).reshape((-1, 3))
+
+    @staticmethod
+    def _evaluate_vectorized(function, times):
+        '''
+        Call a vectorized function with an array of times, returning a Tx3 array of its values
+        '''
+        values = function(times)
+        if values is None or len(values) != 3:
+            raise ValueError('Vectorized motion functions must return 3 values for an array of times')
+        values = [np.asarray(value, dtype=np.float64) for value in values]
+        if any(value.shape not in ((), times.shape) for value in values):
+            raise ValueError('Vectorized motion functions must return scalars or arrays parallel to times')
+        return np.stack(np.broadcast_arrays(*values, times)[:3], axis=1)
 
 
 class Camera:
@@ -340,3 +1063,10 @@ class Camera:
         if len(rotation) != 2:
             raise TypeError('Rotation must have length 2')
         self._rotation = rotation
+
+    @property
+    def view_matrix(self):
+        '''
+        4x4 matrix to convert world coordinates to camera coordinates
+        '''
+        return view_matrix(self._viewpoint, self._rotation)
@@ -0,0 +1,187 @@
+import csv
+import json
+from time import perf_counter
+
+import numpy as np
+import pygame
+
+# Stages of a frame which are timed, in the order they run
+STAGES = ('update', 'cull', 'convert', 'clip', 'project', 'sort', 'draw', 'flip')
+
+# Counters of the work done in a frame. faces counts the faces of the drawn models' meshes, and
+# faces_culled the faces not drawn because their model is outside the view, they face away from the
+# camera or they lie behind the clipping plane.
+COUNTERS = ('models_drawn', 'models_culled', 'faces', 'faces_culled', 'draw_calls')
+
+HISTORY = 300  # number of frames kept by default
+HUD_FRAMES = 30  # number of recent frames averaged in the HUD
+HUD_FONT_SIZE = 16
+HUD_COLOUR = (255, 255, 255)
+HUD_BACKGROUND = (0, 0, 0)
+
+
+class Profiler:
+    '''
+    Records the wall time spent in each stage of a Scene's frames and counters of the work done in
+    them. The most recent frames are kept in fixed-size ring buffers. A disabled profiler ignores
+    every call, so instrumented code costs little more than a method call when profiling is off.
+    '''
+    def __init__(self, history=HISTORY):
+        '''
+        history:    number of frames kept
+        '''
+        if history < 1:
+            raise ValueError('At least one frame must be kept')
+        self.enabled = True
+        self._times = np.zeros((history, len(STAGES) + 1))  # stage times, then the total frame time
+        self._counts = np.zeros((history, len(COUNTERS)), dtype=np.int64)
+        self._frame_times = np.zeros(len(STAGES) + 1)  # times and counters of the current frame
+        self._frame_counts = np.zeros(len(COUNTERS), dtype=np.int64)
+        self._frames = 0  # number of frames recorded
+        self._recording = False  # whether a frame has begun but not ended
+        self._stages = {stage: i for i, stage in enumerate(STAGES)}
+        self._counters = {counter: i for i, counter in enumerate(COUNTERS)}
+        self._starts = np.zeros(len(STAGES) + 1)
+        self._font = None
+
+    @property
+    def history(self):
+        '''
+        Maximum number of frames kept
+        '''
+        return len(self._times)
+
+    @property
+    def n_frames(self):
+        '''
+        Number of complete frames currently held
+        '''
+        return min(self._frames, len(self._times))
+
+    def begin_frame(self):
+        '''
+        Start recording a new frame
+        '''
+        if not self.enabled:
+            return
+        self._frame_times[:] = 0
+        self._frame_counts[:] = 0
+        self._recording = True
+        self._starts[-1] = perf_counter()
+
+    def end_frame(self):
+        '''
+        Finish recording the current frame, recording its total time. The frame is added to the
+        buffers, overwriting the oldest frame if they are full.
+        '''
+        if not self.enabled or not self._recording:
+            return
+        self._frame_times[-1] = perf_counter() - self._starts[-1]
+        row = self._frames % len(self._times)
+        self._times[row] = self._frame_times
+        self._counts[row] = self._frame_counts
+        self._frames += 1
+        self._recording = False
+
+    def discard_frame(self):
+        '''
+        Stop recording the current frame without adding it to the buffers (e.g. when nothing was
+        drawn in it), so that idle frames don't dilute the averages
+        '''
+        self._recording = False
+
+    def start(self, stage):
+        '''
+        Start timing a stage of the current frame
+        '''
+        if not self.enabled:
+            return
+        self._starts[self._stages[stage]] = perf_counter()
+
+    def stop(self, stage):
+        '''
+        Stop timing a stage of the current frame. A stage may be timed several times in a frame
+        (e.g. once per model), in which case its times are summed.
+        '''
+        if not self.enabled or not self._recording:
+            return
+        i = self._stages[stage]
+        self._frame_times[i] += perf_counter() - self._starts[i]
+
+    def count(self, counter, n=1):
+        '''
+        Add n to a counter of the current frame
+        '''
+        if not self.enabled or not self._recording:
+            return
+        self._frame_counts[self._counters[counter]] += n
+
+    def get_frames(self):
+        '''
+        Get the recorded frames, oldest first, as a list of dictionaries of the frame number, the
+        time of each stage and the whole frame (in seconds), and the counters
+        '''
+        end = self._frames
+        frames = []
+        for number in range(end - self.n_frames, end):
+            row = number % len(self._times)
+            frame = {'frame': number}
+            frame.update(zip(STAGES + ('total',), self._times[row].tolist()))
+            frame.update(zip(COUNTERS, self._counts[row].tolist()))
+            frames.append(frame)
+        return frames
+
+    def summary(self, n_frames=None):
+        '''
+        Get the mean time of each stage and the whole frame (in seconds) and the mean counters over
+        the most recent n_frames frames (or all held frames if None)
+        '''
+        n = self.n_frames if n_frames is None else min(n_frames, self.n_frames)
+        if not n:
+            return {}
+        end = self._frames
+        rows = np.arange(end - n, end) % len(self._times)
+        summary = dict(zip(STAGES + ('total',), np.mean(self._times[rows], axis=0).tolist()))
+        summary.update(zip(COUNTERS, np.mean(self._counts[rows], axis=0).tolist()))
+        return summary
+
+    def clear(self):
+        '''
+        Discard all recorded frames
+        '''
+        self._frames = 0
+        self._recording = False
+
+    def to_csv(self, path):
+        '''
+        Write the recorded frames to a CSV file, one row per frame (see get_frames)
+        '''
+        with open(path, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=('frame',) + STAGES + ('total',) + COUNTERS)
+            writer.writeheader()
+            writer.writerows(self.get_frames())
+
+    def to_json(self, path):
+        '''
+        Write the recorded frames to a JSON file as a list of objects (see get_frames)
+        '''
+        with open(path, 'w') as f:
+            json.dump(self.get_frames(), f, indent=2)
+
+    def draw_hud(self, surface, position=(5, 5)):
+        '''
+        Draw the mean stage times and counters of the most recent frames onto a pygame Surface
+        '''
+        summary = self.summary(HUD_FRAMES)
+        if not summary:
+            return
+        if self._font is None:
+            pygame.font.init()
+            self._font = pygame.font.Font(None, HUD_FONT_SIZE)
+        lines = [f'{stage:<8}{1000*summary[stage]:7.2f} ms' for stage in STAGES + ('total',)]
+        lines += [f'{counter:<14}{summary[counter]:.0f}' for counter in COUNTERS]
+        x, y = position
+        for line in lines:
+            text = self._font.render(line, True, HUD_COLOUR, HUD_BACKGROUND)
+            surface.blit(text, (x, y))
+            y += text.get_height()
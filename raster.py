@@ -0,0 +1,297 @@
+import os
+import weakref
+from multiprocessing import Pool
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+
+# Maximum number of candidate pixels processed at once
+CHUNK_SIZE = 2**19
+
+# Distance (in pixels) from a face's edge within which the edge is drawn
+EDGE_WIDTH = 0.75
+
+# Number of tiles (strips of columns) per worker process of a TiledRasterizer, so that busy tiles can be balanced
+TILES_PER_PROCESS = 4
+
+_worker = {}  # shared buffers and frame inputs attached by a TiledRasterizer worker process
+
+
+class Rasterizer:
+    '''
+    Software rasterizer which fills triangles into NumPy colour and depth buffers
+    '''
+    def __init__(self, size, edge_colour=(0, 0, 0), colour=None, depth=None):
+        '''
+        size:           width and height of the buffers in pixels
+        edge_colour:    RGB triplet used to draw face edges, or None to not draw edges
+        colour, depth:  existing WxHx3 uint8 and WxH float arrays to use as the buffers (e.g. in
+                        shared memory), or None to allocate them
+        '''
+        self._size = tuple(size)
+        self._edge_colour = edge_colour
+        # Buffers are indexed by (x, y) to match pygame.surfarray
+        self._colour = np.zeros(self._size + (3,), dtype=np.uint8) if colour is None else colour
+        # Inverse depth (1/z), with 0 being infinitely far away
+        self._depth = np.zeros(self._size) if depth is None else depth
+
+    @property
+    def size(self):
+        '''
+        Width and height of the buffers
+        '''
+        return self._size
+
+    @property
+    def colour_buffer(self):
+        '''
+        WxHx3 colour buffer
+        '''
+        return self._colour
+
+    def clear(self, background):
+        '''
+        Fill the colour buffer with the background colour and reset the depth buffer
+        '''
+        self._colour[:] = background
+        self._depth[:] = 0
+
+    def close(self):
+        '''
+        Release any resources held by the rasterizer
+        '''
+        pass
+
+    def draw(self, points, depths, triangles, colours, edges=None, columns=None):
+        '''
+        Fill triangles into the buffers, keeping the nearest triangle at each pixel.
+            points:     2xN matrix of vertex screen coordinates (floating-point)
+            depths:     array of the N vertex depths (camera z-coordinates, which must be positive)
+            triangles:  Tx3 array of vertex indices
+            colours:    Tx3 array of RGB triangle colours
+            edges:      Tx3 boolean array indicating which of the edges (v0, v1), (v1, v2) and (v2, v0)
+                        of each triangle are drawn
+            columns:    range of pixel columns (first, last + 1) to fill, or None to fill the whole buffer
+        '''
+        if edges is None:
+            edges = np.zeros(triangles.shape, dtype=bool)
+        x, y = points[0, triangles], points[1, triangles]
+        area = (x[:, 1] - x[:, 0])*(y[:, 2] - y[:, 0]) - (x[:, 2] - x[:, 0])*(y[:, 1] - y[:, 0])
+        drawn = area != 0
+        triangles, colours, edges = triangles[drawn], colours[drawn], edges[drawn]
+        x, y, area = x[drawn], y[drawn], area[drawn]
+
+        rows, row_y, starts, widths = self._spans(x, y, (0, self._size[0]) if columns is None else columns)
+
+        # Split the spans into chunks with a bounded number of pixels
+        ends = np.cumsum(widths)
+        start = 0
+        while start < len(rows):
+            end = max(np.searchsorted(ends, ends[start] - widths[start] + CHUNK_SIZE, side='right'), start + 1)
+            chunk = slice(start, end)
+            tri = np.repeat(rows[chunk], widths[chunk])
+            offsets = starts[chunk] - np.cumsum(widths[chunk]) + widths[chunk]
+            px = np.repeat(offsets, widths[chunk]) + np.arange(len(tri))
+            py = np.repeat(row_y[chunk], widths[chunk])
+            self._draw_pixels(tri, px, py, x, y, area, 1/depths[triangles], colours, edges)
+            start = end
+
+    def _spans(self, x, y, columns):
+        '''
+        Find the pixels covered by each triangle (given by Tx3 arrays of vertex screen coordinates) in
+        a range of columns as horizontal spans. Returns the triangle, row, first pixel and number of
+        pixels of each span.
+        '''
+        top = np.clip(np.floor(np.min(y, axis=1)), 0, self._size[1]).astype(int)
+        bottom = np.clip(np.ceil(np.max(y, axis=1)), 0, self._size[1]).astype(int)
+        heights = bottom - top
+        rows = np.repeat(np.arange(len(x)), heights)
+        row_y = np.repeat(top, heights) + np.arange(len(rows)) - np.repeat(np.cumsum(heights) - heights, heights)
+
+        # Intersect the row centers with each edge of the triangle
+        center = row_y + 0.5
+        left = np.full(len(rows), np.inf)
+        right = np.full(len(rows), -np.inf)
+        for i in range(3):
+            j = (i + 1) % 3
+            xa, ya, xb, yb = x[rows, i], y[rows, i], x[rows, j], y[rows, j]
+            crosses = (np.minimum(ya, yb) <= center) & (center <= np.maximum(ya, yb)) & (ya != yb)
+            xc = xa + (center - ya)*(xb - xa)/np.where(crosses, yb - ya, 1)
+            left = np.where(crosses, np.minimum(left, xc), left)
+            right = np.where(crosses, np.maximum(right, xc), right)
+        left = np.maximum(left, np.min(x, axis=1)[rows])
+        right = np.minimum(right, np.max(x, axis=1)[rows])
+
+        # Pixels with centers inside the span
+        starts = np.clip(np.ceil(left - 0.5), columns[0], columns[1])
+        ends = np.clip(np.floor(right - 0.5) + 1, columns[0], columns[1])
+        widths = np.maximum(ends - starts, 0).astype(int)
+        spanned = widths > 0
+        return rows[spanned], row_y[spanned], starts[spanned].astype(int), widths[spanned]
+
+    def _draw_pixels(self, tri, px, py, x, y, area, inv_depths, colours, edges):
+        '''
+        Depth test and fill the pixels covered by triangles (tri gives the triangle covering each pixel)
+        '''
+        # Barycentric weights from the edge functions (opposite each vertex) at the pixel centers
+        cx, cy = px + 0.5, py + 0.5
+        weights = np.empty((3, len(tri)))
+        for i in range(3):
+            j, k = (i + 1) % 3, (i + 2) % 3
+            weights[i] = (x[tri, k] - x[tri, j])*(cy - y[tri, j]) - (y[tri, k] - y[tri, j])*(cx - x[tri, j])
+        weights = weights/area[tri]
+
+        # Perspective-correct depth test, keeping the nearest fragment at each pixel
+        inv_depth = np.sum(weights*inv_depths[tri].T, axis=0)
+        pixel = px*self._size[1] + py
+        order = np.lexsort((-inv_depth, pixel))
+        first = np.ones(len(order), dtype=bool)
+        first[1:] = pixel[order[1:]] != pixel[order[:-1]]
+        best = order[first]
+        best = best[inv_depth[best] > self._depth[px[best], py[best]]]
+        tri, px, py, weights = tri[best], px[best], py[best], weights[:, best]
+
+        self._depth[px, py] = inv_depth[best]
+        self._colour[px, py] = colours[tri]
+        if self._edge_colour is not None and np.any(edges[tri]):
+            # The distance from an edge is the opposite vertex's weight times twice the area over the edge length
+            near = np.zeros(len(tri), dtype=bool)
+            for i in range(3):
+                j, opposite = (i + 1) % 3, (i + 2) % 3
+                length = np.hypot(x[tri, j] - x[tri, i], y[tri, j] - y[tri, i])
+                distance = np.abs(weights[opposite]*area[tri])/np.maximum(length, EDGE_WIDTH)
+                near |= edges[tri, i] & (distance < EDGE_WIDTH)
+            self._colour[px[near], py[near]] = self._edge_colour
+
+
+class TiledRasterizer(Rasterizer):
+    '''
+    Rasterizer which splits the buffers into tiles (strips of columns) and fills them in parallel with
+    a pool of worker processes. The buffers live in shared memory, as do each frame's triangles, which
+    are binned into the tiles they cover so that workers only fill the triangles of their tiles.
+    Tiles are filled exactly as by Rasterizer, so the results are identical.
+    '''
+    def __init__(self, size, edge_colour=(0, 0, 0), processes=None):
+        '''
+        size:           width and height of the buffers in pixels
+        edge_colour:    RGB triplet used to draw face edges, or None to not draw edges
+        processes:      number of worker processes (os.cpu_count() by default)
+        '''
+        width, height = size
+        processes = os.cpu_count() if processes is None else processes
+        buffers = SharedMemory(create=True, size=width*height*(8 + 3))
+        super().__init__(size, edge_colour, *_buffer_views(buffers, size))
+        n_tiles = max(min(processes*TILES_PER_PROCESS, width), 1)
+        self._tiles = np.linspace(0, width, n_tiles + 1).astype(int)
+        self._shared = [buffers, None]  # shared buffers and frame inputs
+        self._pool = Pool(processes, initializer=_attach_buffers, initargs=(buffers.name, size, edge_colour))
+        self._finalizer = weakref.finalize(self, _release, self._pool, self._shared)
+
+    def close(self):
+        '''
+        Stop the worker processes and free the shared memory. The buffers can't be used afterwards.
+        '''
+        self._colour = self._depth = None
+        self._finalizer()
+
+    def draw(self, points, depths, triangles, colours, edges=None, columns=None):
+        '''
+        Fill triangles into the buffers, keeping the nearest triangle at each pixel (see Rasterizer.draw)
+        '''
+        if edges is None:
+            edges = np.zeros(triangles.shape, dtype=bool)
+        bins, offsets = self._bin(points, triangles, columns)
+        arrays = (np.asarray(points, dtype=np.float64), np.asarray(depths, dtype=np.float64),
+                  np.asarray(triangles, dtype=np.int64), np.asarray(colours, dtype=np.uint8),
+                  np.asarray(edges, dtype=bool), bins)
+        name, layout = self._store_inputs(arrays)
+        tasks = [(name, layout, offsets[i], offsets[i + 1], (self._tiles[i], self._tiles[i + 1]))
+                 for i in range(len(self._tiles) - 1) if offsets[i + 1] > offsets[i]]
+        self._pool.map(_draw_tile, tasks, chunksize=1)
+
+    def _bin(self, points, triangles, columns):
+        '''
+        Find the tiles covered by each triangle's range of pixel columns. Returns the triangles in each
+        tile (in their original order, so that ties in depth are resolved as by Rasterizer) as a flat
+        array, and the offsets at which each tile's triangles start (with the total number appended).
+        '''
+        n_tiles = len(self._tiles) - 1
+        x = points[0, triangles]
+        first = np.ceil(np.min(x, axis=1) - 0.5)
+        last = np.floor(np.max(x, axis=1) - 0.5)
+        if columns is not None:
+            first, last = np.maximum(first, columns[0]), np.minimum(last, columns[1] - 1)
+        first_tile = np.clip(np.searchsorted(self._tiles, first, side='right') - 1, 0, n_tiles - 1)
+        last_tile = np.clip(np.searchsorted(self._tiles, last, side='right') - 1, 0, n_tiles - 1)
+        counts = np.where(last >= first, last_tile - first_tile + 1, 0)
+        tiles = np.repeat(first_tile - np.cumsum(counts) + counts, counts) + np.arange(np.sum(counts))
+        order = np.argsort(tiles, kind='stable')
+        bins = np.repeat(np.arange(len(triangles)), counts)[order]
+        return bins, np.searchsorted(tiles[order], np.arange(n_tiles + 1))
+
+    def _store_inputs(self, arrays):
+        '''
+        Copy a frame's arrays into shared memory, growing it if needed. Returns the name of the shared
+        memory and the shape, dtype and offset of each array in it.
+        '''
+        layout = []
+        size = 0
+        for array in arrays:
+            size = -(-size//8)*8  # keep every array 8-byte aligned
+            layout.append((array.shape, array.dtype.str, size))
+            size += array.nbytes
+        inputs = self._shared[1]
+        if inputs is None or inputs.size < size:
+            if inputs is not None:
+                inputs.unlink()
+            inputs = SharedMemory(create=True, size=max(2*size, 1))
+            self._shared[1] = inputs
+        for array, (shape, dtype, offset) in zip(arrays, layout):
+            np.ndarray(shape, dtype=dtype, buffer=inputs.buf, offset=offset)[...] = array
+        return inputs.name, layout
+
+
+def _buffer_views(buffers, size):
+    '''
+    Colour and depth buffers (see Rasterizer) in a block of shared memory
+    '''
+    width, height = size
+    depth = np.ndarray((width, height), dtype=np.float64, buffer=buffers.buf)
+    colour = np.ndarray((width, height, 3), dtype=np.uint8, buffer=buffers.buf, offset=depth.nbytes)
+    return colour, depth
+
+
+def _attach_buffers(name, size, edge_colour):
+    '''
+    Attach a worker process to the shared buffers of a TiledRasterizer
+    '''
+    _worker['buffers'] = SharedMemory(name=name)
+    _worker['rasterizer'] = Rasterizer(size, edge_colour, *_buffer_views(_worker['buffers'], size))
+    _worker['inputs'] = None
+
+
+def _draw_tile(task):
+    '''
+    Fill the triangles binned into a tile in a worker process
+    '''
+    name, layout, start, end, columns = task
+    inputs = _worker['inputs']
+    if inputs is None or inputs.name != name:
+        if inputs is not None:
+            inputs.close()
+        inputs = _worker['inputs'] = SharedMemory(name=name)
+    points, depths, triangles, colours, edges, bins = (
+        np.ndarray(shape, dtype=dtype, buffer=inputs.buf, offset=offset) for shape, dtype, offset in layout)
+    ids = bins[start:end]
+    _worker['rasterizer'].draw(points, depths, triangles[ids], colours[ids], edges[ids], columns)
+
+
+def _release(pool, shared):
+    '''
+    Stop the worker processes of a TiledRasterizer and free its shared memory. The memory is unmapped
+    when the SharedMemory objects are deleted, once no arrays use it.
+    '''
+    pool.terminate()
+    for memory in shared:
+        if memory is not None:
+            memory.unlink()
@@ -1,12 +1,22 @@
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter, sleep
+
 import numpy as np
 import pygame
 
 from manager import ModelManager
 from models import Camera
-from linalg import rotate2d, project2d
+from raster import Rasterizer, TiledRasterizer
+from profiler import Profiler, HISTORY
+from export import export_animation
+from linalg import project_points, triangulate
 
 SCALE_FACTOR = 400  # scaling factor to slow down mouse movements
 MOTION_THRESHOLD = 200  # prevent overly erratic mouse movements
+LOD_THRESHOLDS = (100, 40, 15)  # projected radii (in pixels) below which each simplified mesh is drawn
+TARGET_FPS = 60
+MAX_STEPS = 5  # maximum number of fixed simulation steps taken per frame
+IDLE_INTERVAL = 0.01  # time (in seconds) waited between skipped frames when the frame rate is uncapped
 
 
 class Scene:
@@ -23,6 +33,26 @@ class Scene:
 
         self._model_manager = None
         self._camera = Camera()
+        self._backface_culling = False
+        self._frustum_culling = True
+        self._lod_thresholds = LOD_THRESHOLDS
+        self._rasterizer = 'painter'
+        self._zbuffer = None
+        self._processes = 1  # number of processes filling the z-buffer
+        self._coherent_sort = False
+        self._reset_sort()
+        self._frame_stats = {}
+        self._target_fps = TARGET_FPS
+        self._timestep = None
+        self._max_steps = MAX_STEPS
+        self._render_on_change = False
+        self._redraw = True  # whether the window must be redrawn even if nothing changed
+        self._executor = None  # worker thread evaluating motions when pipelining
+        self._pending = None  # future of the snapshot being evaluated, its time and motions version
+        self._spare = None  # snapshot whose arrays are free to be reused
+        self._profiler = Profiler()
+        self._profiler.enabled = False
+        self._hud = False
 
     def add_manager(self, model_manager):
         '''
@@ -33,6 +63,12 @@ class Scene:
             raise TypeError('Input must be of type ModelManager')
         self._model_manager = model_manager
 
+    def get_manager(self):
+        '''
+        Get the ModelManager registered with the Scene
+        '''
+        return self._model_manager
+
     def set_viewpoint(self, viewpoint):
         '''
         Set the camera position (viewpoint is a 3-element iterable)
@@ -64,6 +100,12 @@ class Scene:
         '''
         self._screen_size = (width, height)
 
+    def get_screen_size(self):
+        '''
+        Get the screen width and height
+        '''
+        return self._screen_size
+
     def set_title(self, title):
         '''
         Set the pygame window title. This should be done before Scene.run() is invoked.
@@ -76,6 +118,150 @@ class Scene:
         '''
         self._camera.clip_plane = distance
 
+    def set_backface_culling(self, enabled):
+        '''
+        Enable or disable back-face culling. When enabled, faces pointing away from the camera are
+        not drawn. This assumes that the faces of every model are wound counter-clockwise (by the
+        right-hand rule) when viewed from outside, as in STL files.
+        '''
+        self._backface_culling = bool(enabled)
+
+    def set_frustum_culling(self, enabled):
+        '''
+        Enable or disable view-frustum culling. When enabled (the default), models whose bounding
+        volumes lie entirely outside the camera's view are skipped without transforming their vertices.
+        '''
+        self._frustum_culling = bool(enabled)
+
+    def set_lod_thresholds(self, thresholds):
+        '''
+        Set the projected radii (in pixels) at which models switch to simpler levels of detail.
+        thresholds must be decreasing: a model whose bounding sphere appears smaller than the i-th
+        threshold is drawn with its i-th simplified mesh, if it has one (see Mesh.build_lods).
+        An empty iterable disables levels of detail.
+        '''
+        thresholds = tuple(float(threshold) for threshold in thresholds)
+        if any(a <= b for a, b in zip(thresholds, thresholds[1:])):
+            raise ValueError('LOD thresholds must be decreasing')
+        self._lod_thresholds = thresholds
+
+    def set_rasterizer(self, rasterizer, processes=1):
+        '''
+        Select how faces are drawn. With 'painter' (the default), faces are sorted by depth and drawn
+        one by one with pygame, farthest first. With 'zbuffer', faces are filled into a depth buffer
+        with NumPy and copied to the screen at once, which is faster for many faces and correctly
+        draws intersecting faces. If processes is not 1, the z-buffer is split into tiles which are
+        filled in parallel by that many worker processes (all cores if None, see TiledRasterizer).
+        '''
+        if rasterizer not in ('painter', 'zbuffer'):
+            raise ValueError(f'Unknown rasterizer {rasterizer}')
+        if processes is not None and processes < 1:
+            raise ValueError('At least one process is needed')
+        self._rasterizer = rasterizer
+        self._processes = processes
+        if self._zbuffer is not None:
+            self._zbuffer.close()
+            self._zbuffer = None
+
+    def set_coherent_sort(self, enabled):
+        '''
+        Enable or disable frame-coherent depth sorting for the painter's algorithm. When enabled,
+        faces are sorted starting from the previous frame's order, which is cheaper when the order
+        barely changes between frames (as in static scenes seen from a still camera), but not when
+        models turn or the camera moves. Faces at equal depths keep their previous order rather
+        than being drawn in model order.
+        '''
+        self._coherent_sort = bool(enabled)
+        self._reset_sort()
+
+    def set_target_fps(self, fps):
+        '''
+        Set the frame rate at which the Scene is run. Each frame only sleeps for the part of its time
+        budget which is left after updating and drawing. A value of 0 runs as fast as possible.
+        '''
+        if fps < 0:
+            raise ValueError('Target frame rate must not be negative')
+        self._target_fps = fps
+
+    def set_fixed_timestep(self, timestep, max_steps=MAX_STEPS):
+        '''
+        Advance the simulation in fixed steps of timestep seconds, independently of the frame rate.
+        Elapsed time is accumulated and consumed in whole steps, so models are always updated at
+        multiples of the timestep. At most max_steps are taken in each frame, so that the simulation
+        slows down rather than falling ever further behind when frames are slow. Since motions are
+        functions of time, models are only updated once per frame, at the time of the last step taken.
+        A timestep of None updates the models once per frame at the elapsed time (the default).
+        '''
+        if timestep is not None and timestep <= 0:
+            raise ValueError('Timestep must be positive')
+        if max_steps < 1:
+            raise ValueError('At least one step must be allowed per frame')
+        self._timestep = timestep
+        self._max_steps = max_steps
+
+    def set_pipelining(self, enabled):
+        '''
+        If enabled, the motions of the models for the next frame are evaluated in a worker thread while
+        the current frame is drawn (see ModelManager.get_snapshot), so that expensive motions overlap
+        with drawing. The finished snapshot is applied between frames, so a frame never shows a partly
+        updated scene. In Scene.run, each frame's time is predicted from the previous frame's duration
+        (or the fixed timestep), while render_frames knows the times in advance.
+        '''
+        if enabled and self._executor is None:
+            self._executor = ThreadPoolExecutor(1)
+        elif not enabled and self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+            self._pending = self._spare = None
+
+    def set_render_on_change(self, enabled):
+        '''
+        If enabled, frames are only drawn when the camera or the models have changed since the last
+        drawn frame (or the window needs to be redrawn), which saves work for mostly static scenes
+        '''
+        self._render_on_change = enabled
+
+    def set_profiling(self, enabled, hud=False, history=HISTORY):
+        '''
+        Enable or disable recording of the time spent in each stage of every frame and of counters of
+        the work done (see get_profiler). If hud is True, recent averages are drawn over the scene.
+        history is the number of frames kept, and changing it discards the recorded frames.
+        '''
+        if history != self._profiler.history:
+            self._profiler = Profiler(history)
+        self._profiler.enabled = enabled
+        self._hud = enabled and hud
+
+    def get_profiler(self):
+        '''
+        Get the Profiler holding the recorded frames, which can be exported with to_csv or to_json
+        '''
+        return self._profiler
+
+    def get_frame_stats(self):
+        '''
+        Get statistics about the most recently drawn frame, such as the number of models drawn
+        and culled, and the level of detail drawn for each model
+        '''
+        return dict(self._frame_stats)
+
+    def pick(self, x, y):
+        '''
+        Find the model under a point on the screen (in pixels). Returns the key of the model, the index
+        of the face under the point and the point on the face in world coordinates, or None if no model
+        is under the point (see ModelManager.raycast).
+        '''
+        if self._model_manager is None:
+            raise ValueError('No ModelManager has been associated with this Scene')
+        if self._camera.proj_x is None:
+            self._update_projection()
+        direction = np.array([(x - self._center[0])/self._camera.proj_x,
+                              (y - self._center[1])/self._camera.proj_y, 1, 0])
+        # Faces nearer than the clipping plane are not drawn, so they cannot be picked
+        min_distance = self._camera.clip_plane*np.linalg.norm(direction)
+        direction = np.matmul(np.linalg.inv(self._camera.view_matrix), direction)[:3]
+        return self._model_manager.raycast(self._camera.viewpoint, direction, min_distance)
+
     def set_background(self, colour):
         '''
         Set the window background. This should be done before Scene.run() is invoked.
@@ -92,11 +278,18 @@ class Scene:
         for which to run the scene. A value of 0 will cause the scene to run indefinitely.
         '''
         self._initialize()
-        time = 0.
+        elapsed = 0.
+        time = 0.  # simulation time
+        steps = 0  # number of fixed steps taken
+        accumulator = 0.  # elapsed time not yet consumed by fixed steps
+        drawn = None  # camera and model state of the last drawn frame
+        profiler = self._profiler
         while True:
+            start = perf_counter()
             dt = self._clock.tick()/1000.
-            time += dt
-            if duration and time > duration:
+            profiler.begin_frame()
+            elapsed += dt
+            if duration and elapsed > duration:
                 self._quit()
 
             self._update_camera(dt, pygame.key.get_pressed())
@@ -104,11 +297,105 @@ class Scene:
             for event in pygame.event.get():
                 self._handle_event(event)
 
-            self._screen.fill(self._background)
-            self._update(time)
-            self._draw_models()
-            pygame.display.flip()
-            pygame.time.wait(5)
+            profiler.start('update')
+            if self._timestep is None:
+                time = elapsed if self._pending is None else self._pending[1]
+                self._update(time, elapsed + dt)
+            else:
+                accumulator += dt
+                n_steps = min(int(accumulator//self._timestep), self._max_steps)
+                accumulator = min(accumulator - n_steps*self._timestep, self._timestep)
+                if n_steps:
+                    steps += n_steps
+                    time = steps*self._timestep
+                    self._update(time, (steps + n_steps)*self._timestep)
+            profiler.stop('update')
+
+            budget = 1/self._target_fps if self._target_fps else 0.
+            state = None
+            if self._render_on_change:
+                state = (tuple(self._camera.viewpoint.ravel()), tuple(self._camera.rotation),
+                         self._model_manager.version)
+            if not self._render_on_change or self._redraw or state != drawn:
+                self._screen.fill(self._background)
+                self._draw_models()
+                if self._hud:
+                    profiler.draw_hud(self._screen)
+                profiler.start('flip')
+                pygame.display.flip()
+                profiler.stop('flip')
+                drawn, self._redraw = state, False
+                profiler.end_frame()
+            else:
+                profiler.discard_frame()
+                if not budget:
+                    budget = IDLE_INTERVAL
+            self._wait(start + budget)
+
+    def render_frame(self, time, next_time=None):
+        '''
+        Render the models at the given time without opening a window, and return the frame as an
+        HxWx3 array of RGB values. Frames are drawn to an offscreen surface (or the window's surface,
+        if the Scene is running), so no display is needed. The camera is only moved by the setters.
+        If pipelining is enabled, the models' state at next_time is evaluated while drawing.
+        '''
+        self._initialize_offscreen()
+        profiler = self._profiler
+        profiler.begin_frame()
+        profiler.start('update')
+        self._update(time, next_time)
+        profiler.stop('update')
+        self._screen.fill(self._background)
+        self._draw_models()
+        if self._hud:
+            profiler.draw_hud(self._screen)
+        profiler.end_frame()
+        return np.transpose(pygame.surfarray.array3d(self._screen), (1, 0, 2))
+
+    def render_frames(self, times):
+        '''
+        Generator of frames rendered at each of the given times (see render_frame)
+        '''
+        times = iter(times)
+        time = next(times, None)
+        while time is not None:
+            next_time = next(times, None)
+            yield self.render_frame(time, next_time)
+            time = next_time
+
+    def export(self, path, t0, t1, fps, processes=None, build_manager=None):
+        '''
+        Render the frames from time t0 up to t1 at fps frames per second and write them to path, as a
+        GIF (.gif), a video encoded by ffmpeg (.mp4, .mkv, .avi, .mov or .webm) or a sequence of PNG
+        images (.png or a directory). Frames are rendered headless by a pool of processes, each of
+        which rebuilds the ModelManager by calling build_manager or by unpickling a copy of it
+        (see export.export_animation).
+        '''
+        export_animation(self, path, t0, t1, fps, processes, build_manager)
+
+    def __getstate__(self):
+        '''
+        Copy the Scene's settings for pickling, leaving out its pygame objects, ModelManager and
+        recorded frames
+        '''
+        state = self.__dict__.copy()
+        state.update(_screen=None, _clock=None, _model_manager=None, _zbuffer=None, _executor=None,
+                     _pending=None, _spare=None, _sort_ids={}, _n_sort_ids=0,
+                     _sort_order=np.zeros(0, dtype=int))
+        state['_profiler'] = Profiler(self._profiler.history)
+        state['_profiler'].enabled = False
+        state['_hud'] = False
+        return state
+
+    @staticmethod
+    def _wait(deadline):
+        '''
+        Wait until the given time (from time.perf_counter). The whole wait is slept rather than spun,
+        so an idle Scene uses no CPU, at the cost of sleep overshooting by up to a millisecond or so.
+        '''
+        remaining = deadline - perf_counter()
+        if remaining > 0:
+            sleep(remaining)
 
     def _initialize(self):
         '''
@@ -121,16 +408,32 @@ class Scene:
         if self._title is not None:
             pygame.display.set_caption(self._title)
         self._screen = pygame.display.set_mode(self._screen_size)
-        self._center = (self._screen_size[0]//2, self._screen_size[1]//2)
         self._clock = pygame.time.Clock()
-        fov = np.pi/2
-        self._camera.proj_x = self._screen_size[0]/2/np.tan(fov/2)/(self._screen_size[0]/self._screen_size[1])
-        self._camera.proj_y = self._screen_size[1]/2/np.tan(fov/2)
+        self._update_projection()
         pygame.event.get()
         pygame.mouse.get_rel()
         pygame.mouse.set_visible(False)
         pygame.event.set_grab(True)
 
+    def _initialize_offscreen(self):
+        '''
+        Initialization of an offscreen surface to render to, if there is no surface of the right size
+        '''
+        if self._model_manager is None:
+            raise ValueError('No ModelManager has been associated with this Scene')
+        if self._screen is None or self._screen.get_size() != self._screen_size:
+            self._screen = pygame.Surface(self._screen_size)
+        self._update_projection()
+
+    def _update_projection(self):
+        '''
+        Update the screen center and the camera's projection factors from the screen size
+        '''
+        self._center = (self._screen_size[0]//2, self._screen_size[1]//2)
+        fov = np.pi/2
+        self._camera.proj_x = self._screen_size[0]/2/np.tan(fov/2)/(self._screen_size[0]/self._screen_size[1])
+        self._camera.proj_y = self._screen_size[1]/2/np.tan(fov/2)
+
     def _update_camera(self, dt, keys):
         '''
         Update the camera position and orientation
@@ -159,42 +462,303 @@ class Scene:
 
     def _draw_models(self):
         '''
-        Draw the models contained in the ModelManager. Models are drawn face-by-face, with all
-        faces from all models being sorted by depth and drawn in reverse order (farthest first).
-        '''
-        faces_to_render = []
-        colours = []
-        depths = []
-        for key in self._model_manager.models:
-            vertices = [self._convert_coords(v) for v in self._model_manager.get_vertices(key, world=True)]
-            faces = self._model_manager.get_faces(key)
-            colour = self._model_manager.get_colour(key)
-            for f in range(len(faces)):
-                face_verts = self._clip([vertices[i] for i in faces[f]], self._camera.clip_plane)
-
-                if len(face_verts) > 2:
-                    faces_to_render.append([project2d(v, self._center, (self._camera.proj_x, self._camera.proj_y))
-                                            for v in face_verts])
-                    colours.append(colour)
-                    depths.append(sum(sum(v[i]/len(face_verts) for v in face_verts)**2 for i in range(3)))
-
-        # Sort by depth and draw from back to front
-        order = sorted(range(len(faces_to_render)), key=lambda i: depths[i], reverse=True)
-        for i in order:
-            pygame.draw.polygon(self._screen, colours[i], faces_to_render[i])
-            for j in range(len(faces_to_render[i])):
-                pygame.draw.line(self._screen, (0, 0, 0), faces_to_render[i][j-1], faces_to_render[i][j])
-
-    def _convert_coords(self, vertex):
-        '''
-        Convert world coordinates to camera coordinates
-        '''
-        x = vertex[0] - self._camera.viewpoint[0]
-        y = vertex[1] - self._camera.viewpoint[1]
-        z = vertex[2] - self._camera.viewpoint[2]
-        x, z = rotate2d((x, z), self._camera.rotation[1])
-        y, z = rotate2d((y, z), self._camera.rotation[0])
-        return x, y, z
+        Draw the models contained in the ModelManager. Models are culled, converted to camera
+        coordinates, clipped and projected, and their faces are then drawn by the selected
+        rasterizer (see set_rasterizer).
+        '''
+        profiler = self._profiler
+        profiler.start('cull')
+        view = self._camera.view_matrix
+        planes = self._frustum_planes()
+        self._frame_stats = {'models_drawn': 0, 'models_culled': 0, 'lod_levels': {}}
+        transforms = {}
+        meshes = {}
+        keys = self._model_manager.models
+        for key, transform in zip(keys, np.matmul(view, self._model_manager.get_mesh_transforms(keys))):
+            if self._frustum_culling and not self._in_frustum(key, transform, planes):
+                self._frame_stats['models_culled'] += 1
+                mesh = self._model_manager.get_mesh(key)
+                profiler.count('faces_culled', len(mesh.face_arrays[1]) - 1)
+                continue
+            self._frame_stats['models_drawn'] += 1
+            transforms[key] = transform
+            lods = self._model_manager.get_mesh(key).lods
+            level = self._lod_level(lods[0], transform, len(lods))
+            self._frame_stats['lod_levels'][key] = level
+            meshes[key] = lods[level]
+        profiler.count('models_drawn', self._frame_stats['models_drawn'])
+        profiler.count('models_culled', self._frame_stats['models_culled'])
+        profiler.stop('cull')
+
+        instances, models = [], []
+        for mesh, keys in self._group_instances(meshes).items():
+            profiler.start('convert')
+            instance_vertices = self._convert_coords(mesh, [transforms[key] for key in keys])
+            profiler.stop('convert')
+            for key, vertices in zip(keys, instance_vertices):
+                instances.append((key, mesh))
+                models.append(self._process_model(key, mesh, transforms[key], vertices))
+
+        if self._rasterizer == 'zbuffer':
+            self._draw_zbuffer(models)
+        else:
+            self._draw_painter(instances, models)
+
+    def _process_model(self, key, mesh, transform, vertices):
+        '''
+        Cull, clip and project the faces of a model, given the transform from its mesh coordinates
+        to camera coordinates and its vertices in camera coordinates. Returns the model's vertices
+        (including any added by clipping) in camera and screen coordinates, the flattened vertex
+        indices and vertex counts of its faces, the indices of its faces in the mesh, and its colour.
+        '''
+        profiler = self._profiler
+        projection = (self._camera.proj_x, self._camera.proj_y)
+
+        # Clip all faces with the same number of vertices together
+        profiler.start('clip')
+        polygons = [(np.zeros(0, dtype=int), np.zeros(0, dtype=int), np.zeros(0, dtype=int))]
+        for face_ids, faces in self._group_faces(*mesh.face_arrays):
+            profiler.count('faces', len(face_ids))
+            if self._backface_culling:
+                front = self._front_faces(mesh, transform, face_ids, faces)
+                face_ids, faces = face_ids[front], faces[front]
+            new_vertices, indices, counts, kept = self._clip(vertices, faces, self._camera.clip_plane)
+            vertices = np.hstack((vertices, new_vertices))
+            polygons.append((indices, counts, face_ids[kept]))
+        indices, counts, face_ids = (np.concatenate(arrays) for arrays in zip(*polygons))
+        profiler.count('faces_culled', len(mesh.face_arrays[1]) - 1 - len(face_ids))
+        profiler.stop('clip')
+
+        # Project every vertex in front of the clipping plane in one call
+        profiler.start('project')
+        visible = vertices[2] >= self._camera.clip_plane
+        screen = np.zeros((2, vertices.shape[1]), dtype=int)
+        screen[:, visible] = project_points(vertices[:, visible], self._center, projection)
+        profiler.stop('project')
+        return vertices, screen, indices, counts, face_ids, self._model_manager.get_colour(key)
+
+    def _draw_painter(self, instances, models):
+        '''
+        Draw faces with pygame using the painter's algorithm. All faces from all models are
+        sorted by depth and drawn in reverse order (farthest first).
+        '''
+        drawn = [i for i, model in enumerate(models) if len(model[3])]
+        if not drawn:
+            self._sort_order = np.zeros(0, dtype=int)
+            return
+        profiler = self._profiler
+        profiler.start('sort')
+        instances = [instances[i] for i in drawn]
+        models = [models[i] for i in drawn]
+        counts = np.concatenate([model[3] for model in models])
+        depths = np.concatenate([self._face_depths(model[0], model[2], model[3]) for model in models])
+        order = self._depth_order(instances, models, depths)
+        profiler.stop('sort')
+
+        # Gather the screen coordinates of every face's vertices in one list
+        profiler.start('draw')
+        points = np.hstack([screen[:, indices] for _, screen, indices, _, _, _ in models]).T.tolist()
+        offsets = np.concatenate(([0], np.cumsum(counts))).tolist()
+        colours = np.repeat(np.arange(len(models)), [len(model[3]) for model in models]).tolist()
+        for i in order.tolist():
+            face = points[offsets[i]:offsets[i + 1]]
+            pygame.draw.polygon(self._screen, models[colours[i]][5], face)
+            for j in range(len(face)):
+                pygame.draw.line(self._screen, (0, 0, 0), face[j-1], face[j])
+        profiler.count('draw_calls', len(order) + offsets[-1])
+        profiler.stop('draw')
+
+    @staticmethod
+    def _face_depths(vertices, indices, counts):
+        '''
+        Squared distances of the centroids of faces (given as flattened vertex indices and vertex
+        counts) from the camera, given a 3xN matrix of vertices in camera coordinates
+        '''
+        starts = np.cumsum(counts) - counts
+        centroids = np.add.reduceat(vertices[:, indices]/np.repeat(counts, counts), starts, axis=1)
+        return np.sum(centroids**2, axis=0)
+
+    def _depth_order(self, instances, models, depths):
+        '''
+        Order in which to draw faces, farthest first. If coherent sorting is enabled, the faces are
+        first arranged in the previous frame's order (with new faces at the end) so that the stable
+        sort only has to fix the few faces which changed places. Faces are matched between frames
+        by model key and mesh face index, so only models drawn with the same mesh are matched.
+        '''
+        if not self._coherent_sort:
+            return np.argsort(-depths, kind='stable')
+
+        # Give every face a persistent id, from the first id of its model's mesh faces
+        ids = []
+        n_mesh_faces = 0
+        for (key, mesh), model in zip(instances, models):
+            n = len(mesh.face_arrays[1]) - 1
+            first = self._sort_ids.get(key)
+            if first is None or first[:2] != (mesh, mesh.version):
+                first = (mesh, mesh.version, self._n_sort_ids)
+                self._sort_ids[key] = first
+                self._n_sort_ids += n
+            ids.append(model[4] + first[2])
+            n_mesh_faces += n
+        ids = np.concatenate(ids)
+
+        # Arrange the faces drawn last frame in their previous order, followed by the new faces
+        positions = np.full(self._n_sort_ids, -1)
+        positions[ids] = np.arange(len(ids))
+        previous = positions[self._sort_order]
+        previous = previous[previous >= 0]
+        seen = np.zeros(len(ids), dtype=bool)
+        seen[previous] = True
+        seeded = np.concatenate((previous, np.flatnonzero(~seen)))
+        order = seeded[np.argsort(-depths[seeded], kind='stable')]
+        self._sort_order = ids[order]
+
+        # Renumber the faces once ids of models which are gone or changed meshes take up most ids
+        if self._n_sort_ids > 2*n_mesh_faces:
+            self._reset_sort()
+        return order
+
+    def _reset_sort(self):
+        '''
+        Forget the previous frame's draw order and the face ids used by coherent sorting
+        '''
+        self._sort_ids = {}  # model's mesh and mesh version, and the id of its mesh's first face
+        self._n_sort_ids = 0
+        self._sort_order = np.zeros(0, dtype=int)  # ids of the previous frame's faces in draw order
+
+    def _draw_zbuffer(self, models):
+        '''
+        Draw faces with the NumPy z-buffer rasterizer. Faces are split into triangles and filled
+        into the rasterizer's buffers, which are then copied to the screen at once.
+        '''
+        self._profiler.start('draw')
+        if self._zbuffer is None or self._zbuffer.size != self._screen_size:
+            if self._zbuffer is not None:
+                self._zbuffer.close()
+            if self._processes == 1:
+                self._zbuffer = Rasterizer(self._screen_size)
+            else:
+                self._zbuffer = TiledRasterizer(self._screen_size, processes=self._processes)
+        self._zbuffer.clear(self._background)
+
+        projection = (self._camera.proj_x, self._camera.proj_y)
+        points, depths, triangles, colours, edges = [], [], [], [], []
+        n_vertices = 0
+        for vertices, _, indices, counts, _, colour in models:
+            model_triangles, model_edges = triangulate(indices, counts)
+            visible = vertices[2] >= self._camera.clip_plane
+            screen = np.zeros((2, vertices.shape[1]))
+            screen[:, visible] = project_points(vertices[:, visible], self._center, projection, discrete=False)
+            points.append(screen)
+            depths.append(np.where(visible, vertices[2], 1))
+            triangles.append(model_triangles + n_vertices)
+            colours.append(np.tile(np.array(colour, dtype=np.uint8), (len(model_triangles), 1)))
+            edges.append(model_edges)
+            n_vertices += vertices.shape[1]
+
+        if n_vertices:
+            self._zbuffer.draw(np.hstack(points), np.concatenate(depths), np.vstack(triangles),
+                               np.vstack(colours), np.vstack(edges))
+        pygame.surfarray.blit_array(self._screen, self._zbuffer.colour_buffer)
+        self._profiler.count('draw_calls', 2 if n_vertices else 1)
+        self._profiler.stop('draw')
+
+    @staticmethod
+    def _convert_coords(mesh, transforms):
+        '''
+        Convert the vertices of a mesh to camera coordinates for each of the given mesh-to-camera
+        transforms (one per model using the mesh), returning a Kx3xN array. All instances of the
+        mesh are transformed in a single operation.
+        '''
+        return np.matmul(np.array(transforms), mesh.vertex_array)[:, :3]
+
+    @staticmethod
+    def _group_instances(meshes):
+        '''
+        Group the keys of models by the Mesh drawn for them, given a dict of each model's Mesh
+        '''
+        groups = {}
+        for key, mesh in meshes.items():
+            groups.setdefault(mesh, []).append(key)
+        return groups
+
+    def _lod_level(self, mesh, transform, n_levels):
+        '''
+        Choose the level of detail of a mesh from the projected radius of its bounding sphere,
+        given the transform from its mesh coordinates to camera coordinates
+        '''
+        if n_levels == 1:
+            return 0
+        center, radius = mesh.bounding_sphere
+        depth = np.dot(transform[2], np.append(center, 1))
+        radius = radius*np.linalg.norm(transform[:3, :3], 2)
+        if depth <= radius:
+            return 0
+        projected = radius*max(self._camera.proj_x, self._camera.proj_y)/depth
+        level = sum(int(projected < threshold) for threshold in self._lod_thresholds)
+        return min(level, n_levels - 1)
+
+    def _frustum_planes(self):
+        '''
+        5x4 matrix of the planes bounding the camera's view (near, left, right, top, bottom) in camera
+        coordinates. Each row (a, b, c, d) is normalized such that a*x + b*y + c*z + d is the distance
+        of a point inside the view from the plane.
+        '''
+        proj_x, proj_y = self._camera.proj_x, self._camera.proj_y
+        width, height = self._screen_size
+        planes = np.array([
+            [0, 0, 1, -self._camera.clip_plane],
+            [proj_x, 0, self._center[0], 0],
+            [-proj_x, 0, width - self._center[0], 0],
+            [0, proj_y, self._center[1], 0],
+            [0, -proj_y, height - self._center[1], 0]
+        ]).astype(np.float64)
+        return planes/np.linalg.norm(planes[:, :3], axis=1).reshape(5, 1)
+
+    def _in_frustum(self, key, transform, planes):
+        '''
+        Check whether a model may be visible, given the transform from its mesh coordinates to camera
+        coordinates. The mesh's bounding sphere is tested against the frustum planes first, followed
+        by the corners of its bounding box if the sphere intersects a plane.
+        '''
+        mesh = self._model_manager.get_mesh(key)
+        center, radius = mesh.bounding_sphere
+        radius = radius*np.linalg.norm(transform[:3, :3], 2)
+        distances = np.matmul(planes, np.matmul(transform, np.append(center, 1)))
+        if np.any(distances < -radius):
+            return False
+        if np.all(distances >= radius):
+            return True
+        lower, upper = mesh.bounding_box
+        corners = np.array([[x, y, z, 1] for x in (lower[0], upper[0])
+                            for y in (lower[1], upper[1]) for z in (lower[2], upper[2])]).T
+        distances = np.matmul(planes, np.matmul(transform, corners))
+        return not np.any(np.all(distances < 0, axis=1))
+
+    @staticmethod
+    def _front_faces(mesh, transform, face_ids, faces):
+        '''
+        Mask of the faces of a mesh which point towards the camera, given the transform from mesh
+        coordinates to camera coordinates. The camera position is converted to mesh coordinates,
+        so a single dot product per face is needed.
+        '''
+        viewpoint = np.linalg.solve(transform, np.array([0, 0, 0, 1.]))
+        vertices = mesh.vertex_array[:3, faces[:, 0]] - viewpoint[:3].reshape(3, 1)
+        normals = mesh.normals[:, face_ids]
+        return np.einsum('ij,ij->j', normals, vertices) < 0
+
+    @staticmethod
+    def _group_faces(indices, offsets):
+        '''
+        Split faces (given as flat vertex indices and face offsets) into arrays of faces with the
+        same number of vertices. Returns a list of pairs of face indices and FxK arrays of vertex indices.
+        '''
+        counts = np.diff(offsets)
+        groups = []
+        for count in np.unique(counts):
+            face_ids = np.flatnonzero(counts == count)
+            groups.append((face_ids, indices[offsets[face_ids].reshape((-1, 1)) + np.arange(count)]))
+        return groups
 
     def _handle_event(self, event):
         '''
@@ -205,6 +769,8 @@ class Scene:
         elif event.type == pygame.KEYDOWN:
             if event.key == pygame.K_ESCAPE:
                 self._quit()
+        elif event.type == pygame.WINDOWEXPOSED:
+            self._redraw = True
 
     def _mouse_motion(self, event):
         '''
@@ -225,41 +791,126 @@ class Scene:
         pygame.quit()
         exit()
 
-    def _update(self, time):
+    def _update(self, time, next_time=None):
         '''
-        Update the models in the Scene
+        Update the models in the Scene. If pipelining, the snapshot evaluated in the background for
+        this time is applied (or evaluated now if there is none), and evaluation of the snapshot for
+        next_time is started. The two snapshots are double-buffered, reusing each other's arrays.
+        A snapshot is thrown away if models or motions changed after it was started (see
+        ModelManager.motions_version), since it may be out of date or have seen them half changed.
         '''
-        self._model_manager.update_models(time)
+        manager = self._model_manager
+        if self._executor is None:
+            manager.update_models(time)
+            return
+        snapshot = None
+        if self._pending is not None:
+            future, pending_time, motions_version = self._pending
+            self._pending = None
+            if motions_version != manager.motions_version:
+                future.exception()  # wait for the worker, ignoring errors from the changes
+            else:
+                snapshot = future.result()
+                if pending_time != time:
+                    snapshot = manager.get_snapshot(time, snapshot)
+        if snapshot is None:
+            snapshot = manager.get_snapshot(time)
+        manager.apply_snapshot(snapshot)
+        if next_time is not None:
+            future = self._executor.submit(manager.get_snapshot, next_time, self._spare)
+            self._pending = (future, next_time, manager.motions_version)
+        self._spare = snapshot
 
-    def _clip(self, face_vertices, clip_dist):
-        '''
-        Clip parts of the face that are 'behind' the camera (see set_clipping_plane)
-        '''
-        i = 0
-        while i < len(face_vertices):
-            if face_vertices[i][2] < clip_dist:
-                sides = []
-                prev_vert = face_vertices[i - 1]
-                next_vert = face_vertices[(i + 1)%len(face_vertices)]
-                if prev_vert[2] >= clip_dist:
-                    sides.append(self._get_z(face_vertices[i], prev_vert, clip_dist))
-                if next_vert[2] >= clip_dist:
-                    sides.append(self._get_z(face_vertices[i], next_vert, clip_dist))
-                face_vertices = face_vertices[:i] + sides + face_vertices[i + 1:]
-                i += len(sides) - 1
-            i += 1
-        return face_vertices
+    @staticmethod
+    def _clip(vertices, faces, clip_dist):
+        '''
+        Clip parts of the faces that are 'behind' the camera (see set_clipping_plane). vertices is
+        a 3xN matrix in camera coordinates and faces is an FxK array of vertex indices. Faces entirely
+        in front of the clipping plane are kept as they are and faces entirely behind it are dropped,
+        so new vertices are only computed for the faces which straddle the plane. Returns a 3xM matrix
+        of new vertices (indexed from N), the flattened vertex indices of the remaining faces, the
+        number of vertices in each remaining face, and the indices of the remaining faces in faces.
+        '''
+        n_faces, n_sides = faces.shape
+        inside = vertices[2, faces] >= clip_dist
+        n_inside = np.sum(inside, axis=1)
+        whole = n_inside == n_sides
+        straddling = np.flatnonzero(whole ^ (n_inside > 0))
+
+        # Table of the vertex indices of each clipped face, padded with -1
+        table = np.full((n_faces, 2*n_sides), -1)
+        table[whole, :n_sides] = faces[whole]
+        new_vertices = np.zeros((3, 0))
+        if len(straddling):
+            face_table, new_vertices = Scene._clip_straddling(
+                vertices, faces[straddling], inside[straddling], clip_dist)
+            table[straddling] = face_table
+
+        counts = np.sum(table >= 0, axis=1)
+        kept = np.flatnonzero(counts > 2)
+        indices = table[kept]
+        return new_vertices, indices[indices >= 0], counts[kept], kept
+
+    @staticmethod
+    def _clip_straddling(vertices, faces, inside, clip_dist):
+        '''
+        Clip faces which cross the clipping plane. Each vertex behind the plane is replaced by its
+        intersections with the edges to its neighbours in front of the plane, visiting the vertices
+        in order such that each clipped vertex sees its already-clipped predecessor.
+        '''
+        n_faces, n_sides = faces.shape
+        points = vertices[:, faces]
+        clipped = np.zeros((3, n_faces, n_sides, 2))
+        clip_idx = np.full((n_faces, n_sides, 2), -1)
+        valid = np.zeros((n_faces, n_sides, 2), dtype=bool)
+
+        # Vertices preceding the current vertex, and at the start of each clipped face
+        last = points[:, :, -1].copy()
+        first = points[:, :, -1].copy()
+        has_first = np.zeros(n_faces, dtype=bool)
+        for j in range(n_sides):
+            vert = points[:, :, j]
+            prev_vert = last
+            next_vert = points[:, :, j + 1] if j < n_sides - 1 else first
+
+            keep = inside[:, j]
+            clipped[:, keep, j, 0] = vert[:, keep]
+            clip_idx[keep, j, 0] = faces[keep, j]
+            valid[keep, j, 0] = True
+
+            prev_side = ~keep & (prev_vert[2] >= clip_dist)
+            clipped[:, prev_side, j, 0] = Scene._get_z(vert[:, prev_side], prev_vert[:, prev_side], clip_dist)
+            valid[prev_side, j, 0] = True
+
+            next_side = ~keep & (next_vert[2] >= clip_dist)
+            clipped[:, next_side, j, 1] = Scene._get_z(vert[:, next_side], next_vert[:, next_side], clip_dist)
+            valid[next_side, j, 1] = True
+
+            ends = (valid[:, j, 0], valid[:, j, 1])
+            last[:, ends[0]] = clipped[:, ends[0], j, 0]
+            last[:, ends[1]] = clipped[:, ends[1], j, 1]
+            for end in (1, 0):
+                start = ~has_first & ends[end]
+                first[:, start] = clipped[:, start, j, end]
+            has_first |= ends[0] | ends[1]
+
+        # Number the new vertices and left-align each face's vertices in the table
+        new = valid & (clip_idx < 0)
+        clip_idx[new] = vertices.shape[1] + np.arange(np.sum(new))
+        valid = valid.reshape(n_faces, -1)
+        rows, cols = np.nonzero(valid)
+        table = np.full((n_faces, 2*n_sides), -1)
+        positions = np.cumsum(valid, axis=1)[rows, cols] - 1
+        table[rows, positions] = clip_idx.reshape(n_faces, -1)[rows, cols]
+        return table, clipped[:, new]
 
     @staticmethod
     def _get_z(v1, v2, min_z):
         '''
-        Modify vertex for clipped face
+        Intersections of the clipping plane with the edges from v1 (behind the plane) to v2 (3xN matrices)
         '''
-        if v2[2] == v1[2] or min_z < v1[2] or min_z > v2[2]:
-            return None
         dx = v2[0] - v1[0]
         dy = v2[1] - v1[1]
         dz = v2[2] - v1[2]
         i = (min_z - v1[2])/dz
-        return v1[0] + dx*i, v1[1] + dy*i, min_z
-
+        return np.vstack((v1[0] + dx*i, v1[1] + dy*i, np.full(v1.shape[1], min_z)))
@@ -0,0 +1,46 @@
+import numpy as np
+
+import orbit_example
+
+TIMES = np.arange(12)/4
+
+
+def bob(time):
+    '''
+    Move cube1 up and down
+    '''
+    return 0, 5*np.sin(time), 0
+
+
+# Changes made to the models and motions after the frame with each index
+EDITS = {
+    2: lambda manager: manager.add_motion('cube1', positions=bob),
+    4: lambda manager: (manager.remove_motion('cube2'), manager.set_position('cube2', (0, 0, 20))),
+    6: lambda manager: manager.set_parent('cube5', None),
+    8: lambda manager: manager.remove_model('cube4'),
+}
+
+
+def render(pipelined, edits=None):
+    '''
+    Render the orbit example, optionally editing its models and motions between frames
+    '''
+    scene = orbit_example.build_scene()
+    scene.set_pipelining(pipelined)
+    frames = []
+    for i, frame in enumerate(scene.render_frames(TIMES)):
+        frames.append(frame)
+        if edits and i in edits:
+            edits[i](scene.get_manager())
+    scene.set_pipelining(False)
+    return frames
+
+
+def test_pipelined_frames_match():
+    for expected, frame in zip(render(False), render(True)):
+        assert np.array_equal(expected, frame)
+
+
+def test_edits_between_frames():
+    for i, (expected, frame) in enumerate(zip(render(False, EDITS), render(True, EDITS))):
+        assert np.array_equal(expected, frame), f'frame {i} differs'